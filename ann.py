@@ -0,0 +1,140 @@
+import os
+import numpy as np
+from index import normalize, top_k_rows
+
+
+class IVFIndex:
+    """An inverted file index for approximate cosine similarity search over a normalized embedding matrix.
+
+    The library is partitioned into n_lists clusters by spherical k-means. A query is only scored against
+    the papers in the n_probe clusters whose centroids are closest to it, so query cost grows with
+    n_probe / n_lists of the library rather than with the whole library.
+    """
+
+    def __init__(self, centroids, list_offsets, list_rows) -> None:
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, n_iter=20, sample_size=None, seed=0):
+        """Clusters a normalized embedding matrix and returns the resulting index.
+
+        Args:
+            embeddings: L2-normalized float32 array of shape (n_papers, dim).
+            n_lists: number of clusters. Defaults to 4 * sqrt(n_papers).
+            n_iter: number of k-means iterations. Defaults to 20.
+            sample_size: number of papers the centroids are trained on. Defaults to 256 per cluster.
+            seed: random seed for the centroid initialization and training sample. Defaults to 0.
+        """
+        n_papers = embeddings.shape[0]
+        if not n_lists:
+            n_lists = max(1, int(4 * np.sqrt(n_papers)))
+        n_lists = min(n_lists, n_papers)
+        if not sample_size:
+            sample_size = 256 * n_lists
+
+        rng = np.random.default_rng(seed)
+        if sample_size < n_papers:
+            sample = embeddings[
+                np.sort(rng.choice(n_papers, sample_size, replace=False))
+            ]
+        else:
+            sample = embeddings
+        sample = np.asarray(sample, dtype=np.float32)
+
+        centroids = sample[rng.choice(sample.shape[0], n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignments = assign(sample, centroids)
+            counts = np.bincount(assignments, minlength=n_lists)
+            order = np.argsort(assignments, kind="stable")
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            empty = counts == 0
+            sums = np.zeros_like(centroids)
+            sums[~empty] = np.add.reduceat(sample[order], starts[~empty], axis=0)
+            ## Re-seed empty clusters with random papers so that every list stays in use.
+            sums[empty] = sample[rng.choice(sample.shape[0], empty.sum())]
+            centroids = normalize(sums)
+
+        assignments = assign(embeddings, centroids)
+        list_rows = np.argsort(assignments, kind="stable")
+        list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(assignments, minlength=n_lists))]
+        )
+
+        return cls(centroids, list_offsets, list_rows)
+
+    def save(self, path_to_index):
+        temporary_path = path_to_index + ".tmp"
+        with open(temporary_path, "wb") as file:
+            np.savez(
+                file,
+                centroids=self.centroids,
+                list_offsets=self.list_offsets,
+                list_rows=self.list_rows,
+            )
+        os.replace(temporary_path, path_to_index)
+
+    @classmethod
+    def load(cls, path_to_index):
+        with np.load(path_to_index) as arrays:
+            return cls(arrays["centroids"], arrays["list_offsets"], arrays["list_rows"])
+
+    def search(self, embeddings, query_embeddings, top_k=5, n_probe=8):
+        """Approximate counterpart of LibraryIndex.search.
+
+        Args:
+            embeddings: the normalized embedding matrix the index was built from.
+            query_embeddings: array of shape (n_queries, dim) or (dim,) of query embeddings.
+            top_k: number of matches to return per query. Defaults to 5.
+            n_probe: number of clusters scanned per query. Higher is slower and more accurate. Defaults to 8.
+
+        Returns:
+            Tuple (indices, scores) of arrays of shape (n_queries, top_k). Rows with fewer than top_k
+            candidates are padded with index -1 and score -inf.
+        """
+        queries = normalize(query_embeddings)
+        n_probe = min(n_probe, self.n_lists)
+        probed_lists, _ = top_k_rows(queries @ self.centroids.T, n_probe)
+
+        indices = np.full((queries.shape[0], top_k), -1, dtype=np.int64)
+        scores = np.full((queries.shape[0], top_k), -np.inf, dtype=np.float32)
+        for query_number, lists in enumerate(probed_lists):
+            candidates = np.sort(
+                np.concatenate(
+                    [
+                        self.list_rows[self.list_offsets[l] : self.list_offsets[l + 1]]
+                        for l in lists
+                    ]
+                )
+            )
+            if len(candidates) == 0:
+                continue
+            candidate_scores = embeddings[candidates] @ queries[query_number]
+            best, best_scores = top_k_rows(candidate_scores[np.newaxis, :], top_k)
+            indices[query_number, : best.shape[1]] = candidates[best[0]]
+            scores[query_number, : best.shape[1]] = best_scores[0]
+
+        return indices, scores
+
+
+def assign(embeddings, centroids, chunk_size=65536):
+    """Returns the index of the closest centroid to each row of embeddings, processed in chunks to bound memory."""
+    assignments = np.empty(embeddings.shape[0], dtype=np.int64)
+    for start in range(0, embeddings.shape[0], chunk_size):
+        chunk = np.asarray(embeddings[start : start + chunk_size], dtype=np.float32)
+        assignments[start : start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+
+    return assignments
+
+
+def build_ivf_index(path_to_library, embeddings, n_lists=None):
+    """Builds an IVF index over a library's normalized embeddings and saves it as ivf.npz next to them."""
+    index = IVFIndex.build(embeddings, n_lists=n_lists)
+    index.save(os.path.join(path_to_library, "ivf.npz"))
+
+    return index
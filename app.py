@@ -1,17 +1,33 @@
+import urllib.error
 import streamlit as st
-import arxiv
-import pandas as pd
 from model import get_recs
+from metadata_store import default_store
+from encoders import warm_up
+from service import request_recs, service_available
 
 
-# Function to extract the details of the paper
+# Function to extract the details of the paper. The metadata store keeps the result, so the
+# fetch inside get_recs for the same id does not call the arXiv API a second time.
 def arxiv_search(input_id):
-    paper = next(arxiv.Search(id_list=[input_id]).results())
+    paper = default_store().get([input_id]).iloc[0]
     return paper
 
 
+# Recommendations come from the long-lived service (python service.py) when it is running, which keeps
+# the model and library loaded and batches concurrent users. Otherwise they are computed in this process.
+def recommend(input_id):
+    try:
+        return request_recs([input_id])
+    except (urllib.error.URLError, OSError):
+        return get_recs(id_list=[input_id])
+
+
 if __name__ == "__main__":
     st.set_page_config(layout="wide")
+    # Without a running service, load the encoder once per process rather than on every recommendation
+    if not service_available():
+        warm_up("allenai-specter")
+
     # Title for the dashboard
     st.title("ArXiv recommender")
 
@@ -23,34 +39,12 @@ if __name__ == "__main__":
         input_data = arxiv_search(input_arxiv_id)
         # Dropdown for the input article
         with st.expander("%s" % input_data.title):
-            st.write("Abstract: ", input_data.summary)
+            st.write("Abstract: ", input_data.abstract)
 
         if st.button("Show Abstract"):
-            st.write("Abstract: ", input_data.summary)
-
-        # Loading the stored corpus and embeddings and topics
-        embeddings = pd.read_feather(
-            "./data/libraries/APSP_50_allenai-specter/embeddings.feather"
-        ).values
-
-        # # Initializing the model
-        # model = sentence_transformers.SentenceTransformer("allenai-specter")
-
-        # # Encoding the title and summary of the input article
-        # input_embedding = model.encode(input_data.summary)
-
-        # # Top 5 recommendations from the corpus
-        # reco = sentence_transformers.util.semantic_search(
-        #     query_embeddings=input_embedding, corpus_embeddings=embeddings, top_k=5
-        # )
-
-        # reco_id = [recs["corpus_id"] for recs in reco[0]]
+            st.write("Abstract: ", input_data.abstract)
 
-        # # Loading the metadata
-        # corpus = pd.read_feather(
-        #     "./data/libraries/APSP_50_allenai-specter/metadata.feather"
-        # )
-        recs = get_recs(id_list=[input_arxiv_id])
+        recs = recommend(input_arxiv_id)
 
         st.write("Top 5 similar articles")
 
@@ -0,0 +1,52 @@
+"""Recall@k and queries per second of the IVF index against exact search on synthetic libraries.
+
+Usage:
+    python -m benchmarks.bench_ann --sizes 10000 100000 1000000 --dim 768
+"""
+
+import argparse
+from ann import IVFIndex
+from benchmarks.common import (
+    synthetic_embeddings,
+    synthetic_queries,
+    exact_top_k,
+    recall_at_k,
+    Timer,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--n-probe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    print("n_papers  method        build_s  recall@k  qps")
+    for n_papers in args.sizes:
+        embeddings = synthetic_embeddings(n_papers, dim=args.dim)
+        queries = synthetic_queries(embeddings, args.queries)
+
+        with Timer() as timer:
+            truth = exact_top_k(embeddings, queries, args.top_k)
+        print(
+            f"{n_papers:<9} {'exact':<13} {0:>7.1f}  {1:>8.3f}  {args.queries / timer.seconds:>8.1f}"
+        )
+
+        with Timer() as build_timer:
+            index = IVFIndex.build(embeddings)
+        for n_probe in args.n_probe:
+            with Timer() as timer:
+                found, _ = index.search(
+                    embeddings, queries, top_k=args.top_k, n_probe=n_probe
+                )
+            print(
+                f"{n_papers:<9} {f'ivf/{n_probe}':<13} {build_timer.seconds:>7.1f}  "
+                f"{recall_at_k(found, truth):>8.3f}  {args.queries / timer.seconds:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Throughput of cleaning.cleanse_all in documents per second against the original per-row pandas
+implementation, and a check that both produce identical output.
+
+Usage:
+    python -m benchmarks.bench_cleaning --docs 100000 --n-jobs 1 4
+"""
+
+import argparse
+import regex
+from cleaning import cleanse_all, cleaning_pool
+from metadata_store import fake_papers
+from benchmarks.common import Timer
+
+
+def legacy_cleanse(string):
+    """The original cleaning implementation: five uncompiled passes per string."""
+    string = string.replace("\n", " ")
+    string = regex.sub(r"\\[\'\"\^\`H\~ckl=bdruvtoi]\{([a-z])\}", r"\1", string)
+    string = regex.sub(r"\\[a-z]{2,}{[^{}]+?}", "", string)
+    string = regex.sub(r"\\[\'\"\^\`H\~ckl=bdruvtoi]([a-z])", r"\1", string)
+    string = regex.sub(r"\s(\$\$?)[^\$]*?\1\S*", " LATEX ", string)
+    return string
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=50000)
+    parser.add_argument("--n-jobs", type=int, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    abstracts = fake_papers([f"bench.{i}" for i in range(args.docs)]).abstract
+    ## Mix in accents and environments, which the synthetic abstracts lack.
+    abstracts = [
+        (
+            abstract
+            + ' by Erd\\H{o}s and G\\"odel, see \\cite{ref} and \\textbf{Theorem}\n'
+            if i % 3 == 0
+            else abstract
+        )
+        for i, abstract in enumerate(abstracts)
+    ]
+
+    with Timer() as timer:
+        expected = [legacy_cleanse(abstract) for abstract in abstracts]
+    print(f"{'legacy':<12} {args.docs / timer.seconds:>12.0f} docs/s")
+
+    for n_jobs in args.n_jobs:
+        ## Start the workers before timing, as library builds keep one pool for the whole build.
+        with cleaning_pool(n_jobs) as pool:
+            cleanse_all(abstracts[: 4 * n_jobs], n_jobs=n_jobs, chunk_size=4, pool=pool)
+            with Timer() as timer:
+                cleaned = cleanse_all(abstracts, n_jobs=n_jobs, pool=pool)
+        identical = "identical" if cleaned == expected else "DIFFERENT"
+        print(
+            f"{f'n_jobs={n_jobs}':<12} {args.docs / timer.seconds:>12.0f} docs/s  {identical}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Documents per second of encoding a synthetic corpus with one call to SentenceTransformer.encode, as
+library builds did before, against EncodingPool with length-bucketed batches over different numbers of
+worker processes, with a check that every run returns the same embeddings in the same order.
+
+Abstract lengths are drawn from a log-normal distribution, since the gain from bucketing comes from the
+spread of lengths. --model takes any sentence transformer name or local path.
+
+Usage:
+    python -m benchmarks.bench_encoding --model all-MiniLM-L6-v2 --docs 4000 --workers 1 2 4
+"""
+
+import argparse
+import numpy as np
+from cleaning import TextCleaner
+from encoders import EncodingPool, get_encoder
+from metadata_store import fake_papers
+from benchmarks.common import Timer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--token-budget", type=int, default=8192)
+    parser.add_argument("--max-batch-size", type=int, default=128)
+    args = parser.parse_args()
+
+    sentences = synthetic_documents(args.docs)
+    lengths = [len(sentence.split()) for sentence in sentences]
+    print(
+        f"{len(sentences)} documents, words per document: median {np.median(lengths):.0f}, "
+        f"95th percentile {np.percentile(lengths, 95):.0f}, max {max(lengths)}"
+    )
+
+    ## Load the model and run one pass before timing, as the pool's workers do when they start.
+    model = get_encoder(args.model)
+    model.encode(sentences=sentences[:8])
+    with Timer() as timer:
+        baseline = np.asarray(model.encode(sentences=sentences), dtype=np.float32)
+    report("single call", len(sentences), timer.seconds, True)
+
+    for n_workers in args.workers:
+        with EncodingPool(
+            args.model,
+            n_workers=n_workers,
+            token_budget=args.token_budget,
+            max_batch_size=args.max_batch_size,
+        ) as pool:
+            pool.encode(sentences[: 8 * n_workers])
+            with Timer() as timer:
+                embeddings = pool.encode(sentences)
+        same = np.allclose(embeddings, baseline, atol=1e-4)
+        report(f"pool, {n_workers} workers", len(sentences), timer.seconds, same)
+
+
+def synthetic_documents(n_docs, seed=0):
+    """Returns n_docs cleaned fake abstracts cut to log-normally distributed word counts."""
+    rng = np.random.default_rng(seed)
+    sentences = TextCleaner().transform(
+        fake_papers([f"2301.{number:05d}v1" for number in range(n_docs)])
+    )
+    lengths = np.clip(rng.lognormal(mean=4.8, sigma=0.5, size=n_docs), 10, 500)
+    documents = []
+    for sentence, length in zip(sentences, lengths.astype(int)):
+        words = sentence.split()
+        documents.append(" ".join((words * (length // len(words) + 1))[:length]))
+
+    return documents
+
+
+def report(name, n_docs, seconds, same):
+    print(
+        f"{name:<18} {n_docs / seconds:>8.1f} docs/s   "
+        f"same embeddings as single call: {same}"
+    )
+
+
+if __name__ == "__main__":
+    main()
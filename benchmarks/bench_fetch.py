@@ -0,0 +1,62 @@
+"""Wall time of sequential and concurrent arXiv fetching against a local fake API with simulated latency,
+checking that both return the same rows in the same order and that the rate limit holds.
+
+Usage:
+    python -m benchmarks.bench_fetch --ids 2000 --latency 0.5 --interval 0.05 --workers 1 4 8
+"""
+
+import argparse
+import numpy as np
+from storage import ArxivFetcher, RateLimiter
+from benchmarks.fake_arxiv import FakeArxivServer
+from benchmarks.common import Timer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ids", type=int, default=2000)
+    parser.add_argument("--results", type=int, default=5000)
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--fail-every", type=int, default=7)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    id_list = [f"2305.{number:05d}" for number in range(args.ids)]
+    reference = {}
+
+    for n_workers in args.workers:
+        with FakeArxivServer(
+            total_results=args.results,
+            latency=args.latency,
+            fail_every=args.fail_every,
+        ) as server:
+            fetcher = ArxivFetcher(
+                n_workers=n_workers,
+                page_size=args.page_size,
+                backoff=0.01,
+                rate_limiter=RateLimiter(args.interval),
+                query_url_format=server.query_url_format,
+            )
+            for task, fetch in [
+                ("ids", lambda: fetcher.fetch_ids(id_list)),
+                ("query", lambda: fetcher.query("cat:math.AP", args.results)),
+            ]:
+                server.request_times.clear()
+                with Timer() as timer:
+                    papers = fetch()
+
+                reference.setdefault(task, papers)
+                identical = papers.id.equals(reference[task].id)
+                gap = np.diff(server.request_times).min(initial=np.inf)
+                print(
+                    f"{task:<6} workers={n_workers:<3} {len(papers):>6} papers   "
+                    f"{timer.seconds:>7.2f} s   {len(papers) / timer.seconds:>8.0f} papers/s   "
+                    f"requests {len(server.request_times):>4}   min gap {gap:.3f} s   "
+                    f"same rows and order: {identical}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Cold import time of the project's entry points, each measured in a fresh interpreter, and a check that
+the cleaning-only and search-only entry points do not load the heavy dependencies. Exits with status 1 if
+an entry point loads a dependency it should not.
+
+Usage:
+    python -m benchmarks.bench_imports --repeats 5
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+HEAVY = ["torch", "sentence_transformers", "sklearn", "scipy", "arxiv"]
+
+## (name, statement, heavy modules the entry point must not load)
+ENTRY_POINTS = [
+    ("cleaning", "from cleaning import cleanse_all", ["torch", "arxiv"]),
+    (
+        "search-only",
+        "from index import open_library",
+        ["torch", "sklearn", "scipy", "arxiv"],
+    ),
+    (
+        "filters",
+        "from filters import FilterIndex",
+        ["torch", "sklearn", "scipy", "arxiv"],
+    ),
+    ("search", "from search import Search", ["torch", "arxiv"]),
+    ("metadata", "from metadata_store import MetadataStore", ["torch", "arxiv"]),
+    ("model", "from model import get_recs", ["torch", "arxiv"]),
+    ("service", "import service", ["torch", "arxiv"]),
+    ("library", "import library", ["torch", "arxiv"]),
+]
+
+MEASURE = """
+import sys, time, json
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(statement):
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE.format(statement=statement, heavy=HEAVY)],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    failed = False
+    for name, statement, forbidden in ENTRY_POINTS:
+        runs = [measure(statement) for _ in range(args.repeats)]
+        loaded = runs[-1]["loaded"]
+        unexpected = [module for module in loaded if module in forbidden]
+        failed = failed or bool(unexpected)
+        print(
+            f"{name:<12} {np.median([run['seconds'] for run in runs]):>7.3f} s   "
+            f"loads {', '.join(loaded) or 'none of ' + ', '.join(HEAVY)}"
+            + (f"   UNEXPECTED: {', '.join(unexpected)}" if unexpected else "")
+        )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Time and memory taken to open a library and return the metadata of top_k search results, reading all of
+metadata.feather into pandas as Search used to, against reading only the matched rows from the
+memory-mapped metadata.arrow, with a check that both return the same rows. Peak memory is as seen by
+tracemalloc, which does not count Arrow's own buffers, so it understates the cost of the full frame.
+
+Usage:
+    python -m benchmarks.bench_metadata --papers 200000 --queries 100
+"""
+
+import os
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from index import MetadataTable, load_metadata_table
+from benchmarks.common import synthetic_library, Timer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--papers", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic_library(directory, args.papers, dim=8)
+        load_metadata_table(directory).close()
+        rng = np.random.default_rng(0)
+        row_lists = [
+            rng.integers(args.papers, size=args.top_k) for _ in range(args.queries)
+        ]
+
+        tracemalloc.start()
+        with Timer() as open_timer:
+            metadata = pd.read_feather(os.path.join(directory, "metadata.feather"))
+        with Timer() as query_timer:
+            expected = [metadata.iloc[rows] for rows in row_lists]
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del metadata
+        report("full frame", args, open_timer, query_timer, peak, True)
+
+        for columns in [None, ["id", "title"]]:
+            tracemalloc.start()
+            with Timer() as open_timer:
+                table = MetadataTable(os.path.join(directory, "metadata.arrow"))
+            with Timer() as query_timer:
+                found = [table.take(rows, columns) for rows in row_lists]
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            table.close()
+            same = all(
+                part.equals(whole[part.columns]) for part, whole in zip(found, expected)
+            )
+            name = "lazy rows" if columns is None else "lazy id, title"
+            report(name, args, open_timer, query_timer, peak, same)
+
+
+def report(name, args, open_timer, query_timer, peak, same):
+    print(
+        f"{name:<15} open {open_timer.seconds * 1000:>8.1f} ms   "
+        f"{query_timer.seconds / args.queries * 1000:>7.3f} ms/query   "
+        f"peak {peak / 2**20:>7.1f} MiB   same rows: {same}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Throughput and peak memory of exact search streamed from disk in row blocks of different sizes, against
+searching a library held in memory, with a check that every block size returns identical results.
+
+Usage:
+    python -m benchmarks.bench_out_of_core --papers 200000 --dim 768 --block-rows 4096 16384 65536
+"""
+
+import os
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from index import open_library, normalize, top_k_rows
+from benchmarks.common import synthetic_library, synthetic_queries, Timer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--papers", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=64)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument(
+        "--block-rows", type=int, nargs="+", default=[1024, 4096, 16384, 65536]
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic_library(directory, args.papers, dim=args.dim)
+        library = open_library(directory)
+        queries = synthetic_queries(library.embeddings, args.queries)
+        path_to_npy = os.path.join(directory, "embeddings.npy")
+
+        ## The old path: load the whole matrix, then score it in one product.
+        tracemalloc.start()
+        with Timer() as timer:
+            in_memory = np.load(path_to_npy)
+            truth = top_k_rows(normalize(queries) @ in_memory.T, args.top_k)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del in_memory
+        report("in memory", args, timer.seconds, peak, True)
+
+        for block_rows in args.block_rows:
+            tracemalloc.start()
+            with Timer() as timer:
+                found = library.search(queries, top_k=args.top_k, block_rows=block_rows)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            identical = np.array_equal(found[0], truth[0]) and np.array_equal(
+                found[1], truth[1]
+            )
+            report(f"block {block_rows}", args, timer.seconds, peak, identical)
+
+
+def report(name, args, seconds, peak, identical):
+    print(
+        f"{name:<12} {args.queries / seconds:>8.1f} queries/s   "
+        f"{args.queries * args.papers / seconds / 1e6:>8.1f} M scores/s   "
+        f"peak {peak / 2**20:>8.1f} MiB   identical to in-memory: {identical}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""Throughput, latency percentiles and peak memory of each stage of the recommendation pipeline, of the
+whole pipeline, and of a library build, on a synthetic corpus, written to a JSON file so that runs on
+different commits can be compared.
+
+Every stage runs offline: Fetch uses a FakeBackend, library.main fetches from a local fake arXiv API, and
+the encoder is a hash-seeded stub unless a (small) sentence transformer is named with --model.
+
+Usage:
+    python -m benchmarks.bench_pipeline --papers 20000 --requests 50 --batch 8
+    python -m benchmarks.bench_pipeline --model all-MiniLM-L6-v2 --compare benchmarks/results/pipeline_abc1234.json
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import library
+from storage import Fetch, RateLimiter, default_fetcher
+from cleaning import TextCleaner
+from embedding import Embedder
+from encoders import registry, get_encoder
+from metadata_store import MetadataStore, FakeBackend
+from index import open_library
+from search import Search
+from benchmarks.fake_arxiv import FakeArxivServer
+from benchmarks.common import synthetic_library, StubEncoder, peak_rss_mib
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--papers", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--model", default="stub")
+    parser.add_argument("--fetch-latency", type=float, default=0.0)
+    parser.add_argument("--library-results", type=int, default=2000)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None)
+    args = parser.parse_args()
+
+    if args.model == "stub":
+        registry.register("stub", StubEncoder(args.dim))
+    else:
+        args.dim = get_encoder(args.model).get_sentence_embedding_dimension()
+
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": vars(args),
+        "stages": [],
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        path_to_library = os.path.join(directory, "library")
+        synthetic_library(path_to_library, args.papers, dim=args.dim)
+        open_library(path_to_library)
+
+        store = MetadataStore(
+            os.path.join(directory, "metadata.sqlite"),
+            backend=FakeBackend(latency=args.fetch_latency),
+        )
+        fetch = Fetch(store=store)
+        clean = TextCleaner()
+        embed = Embedder(model_name=args.model)
+        search = Search(path_to_library, top_k=args.top_k, batch=True)
+        steps = [fetch, clean, embed, search]
+
+        ## Ids outside the library, fresh for every request, so that every fetch reaches the backend.
+        requests = [
+            [f"2309.{request * args.batch + paper:05d}" for paper in range(args.batch)]
+            for request in range(2 * args.requests)
+        ]
+
+        papers = time_stage(
+            results, "fetch", fetch.transform, requests[: args.requests]
+        )
+        documents = time_stage(results, "clean", clean.transform, papers)
+        embeddings = time_stage(results, "embed", embed.transform, documents)
+        time_stage(results, "search", search.transform, embeddings)
+        time_stage(
+            results,
+            "end_to_end",
+            lambda id_list: run_steps(steps, id_list),
+            requests[args.requests :],
+        )
+        time_library_build(results, args)
+
+    for stage in results["stages"]:
+        print(
+            f"{stage['stage']:<12} {stage['throughput']:>10.1f} items/s   "
+            f"p50 {stage['p50_ms']:>9.2f} ms   p95 {stage['p95_ms']:>9.2f} ms   "
+            f"p99 {stage['p99_ms']:>9.2f} ms   peak RSS {stage['peak_rss_mib']:>7.1f} MiB"
+        )
+
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"pipeline_{commit or 'unknown'}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        file.write(json.dumps(results, indent=2))
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(args.compare, results)
+
+
+def time_stage(results, name, function, inputs):
+    """Calls function once per item of inputs, recording the latency of each call.
+
+    Returns:
+        The list of outputs, so the next stage can be timed on them.
+    """
+    outputs = []
+    latencies = []
+    n_items = 0
+    for item in inputs:
+        start = time.perf_counter()
+        outputs.append(function(item))
+        latencies.append(time.perf_counter() - start)
+        n_items += len(item)
+
+    results["stages"].append(summary(name, latencies, n_items))
+
+    return outputs
+
+
+def run_steps(steps, X):
+    ## The same chain of transforms as the Pipeline in model.get_recs.
+    for step in steps:
+        X = step.transform(X)
+    return X
+
+
+def time_library_build(results, args):
+    """Times library.main building a library of library_results papers from a local fake arXiv API."""
+    fetcher = default_fetcher()
+    original = fetcher.query_url_format, fetcher.rate_limiter
+    library_name = f"_benchmark_{os.getpid()}"
+
+    with FakeArxivServer(total_results=args.library_results) as server:
+        fetcher.query_url_format, fetcher.rate_limiter = (
+            server.query_url_format,
+            RateLimiter(0),
+        )
+        try:
+            start = time.perf_counter()
+            library.main(
+                library_name,
+                "cat:math.AP",
+                args.library_results,
+                args.model,
+                chunk_size=500,
+                use_cache=False,
+            )
+            latency = time.perf_counter() - start
+        finally:
+            fetcher.query_url_format, fetcher.rate_limiter = original
+            shutil.rmtree(
+                os.path.join("./data/libraries", library_name), ignore_errors=True
+            )
+
+    results["stages"].append(summary("library_main", [latency], args.library_results))
+
+
+def summary(name, latencies, n_items):
+    latencies = np.asarray(latencies)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+
+    return {
+        "stage": name,
+        "requests": len(latencies),
+        "items": n_items,
+        "seconds": float(latencies.sum()),
+        "throughput": float(n_items / latencies.sum()),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "peak_rss_mib": peak_rss_mib(),
+    }
+
+
+def compare(path_to_baseline, results):
+    """Prints the change in throughput and p95 latency of every stage against an earlier results file."""
+    with open(path_to_baseline, "r") as file:
+        baseline = json.loads(file.read())
+    before = {stage["stage"]: stage for stage in baseline["stages"]}
+
+    print(f"Compared with {baseline['commit']}:")
+    for stage in results["stages"]:
+        if stage["stage"] not in before:
+            continue
+        old = before[stage["stage"]]
+        print(
+            f"{stage['stage']:<12} throughput {stage['throughput'] / old['throughput'] - 1:>+7.1%}   "
+            f"p95 {stage['p95_ms'] / old['p95_ms'] - 1:>+7.1%}"
+        )
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Memory saved and recall@k change of float16 and int8 embedding storage, with and without exact
+re-ranking, on a synthetic library.
+
+Usage:
+    python -m benchmarks.bench_quantization --papers 200000 --dim 768
+"""
+
+import argparse
+from quantize import QuantizedEmbeddings, quantize
+from benchmarks.common import (
+    synthetic_embeddings,
+    synthetic_queries,
+    exact_top_k,
+    recall_at_k,
+    Timer,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--papers", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--rerank", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    embeddings = synthetic_embeddings(args.papers, dim=args.dim)
+    queries = synthetic_queries(embeddings, args.queries)
+    truth = exact_top_k(embeddings, queries, args.top_k)
+
+    print(
+        f"float32   {embeddings.nbytes / 2**20:>9.1f} MiB   recall@{args.top_k} 1.000"
+    )
+    for dtype in ["float16", "int8"]:
+        quantized = QuantizedEmbeddings(*quantize(embeddings, dtype))
+        saved = 1 - quantized.nbytes / embeddings.nbytes
+        for rerank in args.rerank:
+            with Timer() as timer:
+                found, _ = quantized.search(
+                    embeddings, queries, top_k=args.top_k, rerank=rerank
+                )
+            print(
+                f"{dtype:<9} {quantized.nbytes / 2**20:>9.1f} MiB ({saved:.0%} saved)   "
+                f"rerank={rerank}   recall@{args.top_k} {recall_at_k(found, truth):.3f}   "
+                f"{args.queries / timer.seconds:.0f} qps"
+            )
+
+
+if __name__ == "__main__":
+    main()
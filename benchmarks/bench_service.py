@@ -0,0 +1,84 @@
+"""Throughput of the recommendation service under concurrent single-paper requests, with and without
+micro-batching, on a synthetic library served over local HTTP.
+
+Usage:
+    python -m benchmarks.bench_service --papers 20000 --clients 1 8 32 --requests 20
+"""
+
+import os
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from encoders import registry
+from metadata_store import MetadataStore, FakeBackend
+from embedding_cache import EmbeddingCache
+from service import RecommendationService, request_recs
+from benchmarks.common import synthetic_library, StubEncoder, Timer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--papers", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    registry.register("stub", StubEncoder(args.dim))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path_to_library = os.path.join(directory, "library")
+        synthetic_library(path_to_library, args.papers, dim=args.dim)
+
+        for max_batch in [1, 64]:
+            service = RecommendationService(
+                path_to_library=path_to_library,
+                model_name="stub",
+                store=MetadataStore(
+                    os.path.join(directory, f"metadata_{max_batch}.sqlite"),
+                    backend=FakeBackend(),
+                ),
+                cache=EmbeddingCache(
+                    os.path.join(directory, f"embeddings_{max_batch}.sqlite")
+                ),
+                max_batch=max_batch,
+                max_wait=args.max_wait_ms / 1000,
+            )
+            service.warm_up()
+            server = service.serve(port=0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{server.server_port}"
+
+            for n_clients in args.clients:
+                ## Fresh ids for every run so that nothing is answered from the caches.
+                id_lists = [
+                    [f"{n_clients:02d}{max_batch:02d}.{request:05d}"]
+                    for request in range(n_clients * args.requests)
+                ]
+                batches_before = service.batcher.batches
+                with ThreadPoolExecutor(
+                    max_workers=n_clients
+                ) as pool, Timer() as timer:
+                    results = list(
+                        pool.map(
+                            lambda id_list: request_recs(id_list, url=url), id_lists
+                        )
+                    )
+
+                batches = service.batcher.batches - batches_before
+                print(
+                    f"max_batch={max_batch:<3} clients={n_clients:<3} "
+                    f"{len(id_lists) / timer.seconds:>8.1f} requests/s   "
+                    f"mean batch {len(id_lists) / batches:>5.1f}   "
+                    f"all answered: {all(len(result) == 5 for result in results)}"
+                )
+
+            server.shutdown()
+            server.server_close()
+            service.batcher.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Shared helpers for the benchmark scripts. Run benchmarks from the repository root as modules,
+e.g. `python -m benchmarks.bench_ann`, so that the project modules are importable.
+"""
+
+import os
+import time
+import hashlib
+import resource
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from index import normalize, blocked_top_k
+
+
+def synthetic_embeddings(n_papers, dim=768, n_topics=None, seed=0):
+    """Returns normalized float32 embeddings drawn from a mixture of Gaussian topics, which mimics the
+    clustered structure of real paper embeddings far better than uniform noise.
+    """
+    rng = np.random.default_rng(seed)
+    if not n_topics:
+        n_topics = max(1, int(np.sqrt(n_papers)))
+    topics = rng.normal(size=(n_topics, dim)).astype(np.float32)
+
+    embeddings = np.empty((n_papers, dim), dtype=np.float32)
+    chunk_size = 65536
+    for start in range(0, n_papers, chunk_size):
+        stop = min(start + chunk_size, n_papers)
+        chunk_topics = rng.integers(n_topics, size=stop - start)
+        embeddings[start:stop] = topics[chunk_topics] + rng.normal(
+            scale=0.8, size=(stop - start, dim)
+        ).astype(np.float32)
+        embeddings[start:stop] = normalize(embeddings[start:stop])
+
+    return embeddings
+
+
+def synthetic_queries(embeddings, n_queries, seed=1):
+    """Returns queries that are noisy copies of random papers in embeddings."""
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(embeddings.shape[0], size=n_queries)
+    noise = rng.normal(scale=0.02, size=(n_queries, embeddings.shape[1]))
+
+    return normalize(embeddings[rows] + noise.astype(np.float32))
+
+
+def exact_top_k(embeddings, queries, top_k, chunk_size=65536):
+    """Exact cosine top_k of normalized queries against normalized embeddings, chunked over the
+    library so that the score matrix stays small.
+    """
+    indices, _ = blocked_top_k(
+        lambda start, stop: queries @ embeddings[start:stop].T,
+        embeddings.shape[0],
+        top_k,
+        block_rows=chunk_size,
+    )
+
+    return indices
+
+
+def recall_at_k(found, truth):
+    """Fraction of the exact top-k neighbours that appear in the approximate top-k, averaged over queries."""
+    hits = [len(set(f) & set(t)) for f, t in zip(found.tolist(), truth.tolist())]
+
+    return sum(hits) / truth.size
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.perf_counter() - self.start
+
+
+def synthetic_library(path_to_library, n_papers, dim=768, seed=0):
+    """Writes a library of n_papers synthetic papers, see metadata_store.fake_papers, with clustered random
+    embeddings to path_to_library.
+
+    Returns:
+        The list of the arXiv ids in the library.
+    """
+    from library import METADATA_SCHEMA
+    from metadata_store import fake_papers
+
+    os.makedirs(path_to_library, exist_ok=True)
+    id_list = [f"2201.{number:05d}v1" for number in range(n_papers)]
+    feather.write_feather(
+        pa.Table.from_pandas(
+            fake_papers(id_list), schema=METADATA_SCHEMA, preserve_index=False
+        ),
+        os.path.join(path_to_library, "metadata.feather"),
+    )
+    embeddings = synthetic_embeddings(n_papers, dim=dim, seed=seed)
+    feather.write_feather(
+        pd.DataFrame(embeddings, columns=[str(column) for column in range(dim)]),
+        os.path.join(path_to_library, "embeddings.feather"),
+    )
+
+    return id_list
+
+
+class StubEncoder:
+    """Stands in for a sentence transformer: each text is mapped to a pseudo-random unit vector seeded by
+    its hash, so the pipeline can be run and timed without downloading a model.
+    """
+
+    def __init__(self, dim=768) -> None:
+        self.dim = dim
+
+    def encode(self, sentences, **kwargs):
+        embeddings = np.empty((len(sentences), self.dim), dtype=np.float32)
+        for row, sentence in enumerate(sentences):
+            seed = int.from_bytes(hashlib.sha256(sentence.encode()).digest()[:8], "big")
+            embeddings[row] = np.random.default_rng(seed).normal(size=self.dim)
+
+        return normalize(embeddings)
+
+    def parameters(self):
+        return []
+
+
+def peak_rss_mib():
+    """Peak resident set size of this process so far, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## Linux reports KiB, macOS bytes.
+    return peak / 2**20 if os.uname().sysname == "Darwin" else peak / 2**10
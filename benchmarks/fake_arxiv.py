@@ -0,0 +1,134 @@
+"""A local stand-in for the arXiv API, for exercising storage.ArxivFetcher without the network.
+
+Usage:
+    with FakeArxivServer(latency=0.5) as server:
+        fetcher = ArxivFetcher(query_url_format=server.query_url_format)
+"""
+
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape, quoteattr
+import pandas as pd
+from metadata_store import fake_papers
+
+
+class FakeArxivServer:
+    """Serves Atom feeds in the format of the arXiv API, built from metadata_store.fake_papers.
+
+    Id lookups return one synthetic paper per id. Every search query matches the same corpus of
+    total_results papers, newest first. Each response is delayed by latency seconds, and every fail_every-th
+    request is answered with a 503, like arXiv under load. The start time of every request is recorded in
+    request_times.
+    """
+
+    def __init__(self, total_results=10000, latency=0.0, fail_every=None) -> None:
+        self.total_results = total_results
+        self.latency = latency
+        self.fail_every = fail_every
+        self.request_times = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def query_url_format(self):
+        return f"http://127.0.0.1:{self._server.server_port}/api/query?{{}}"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def feed(self, arguments):
+        start = int(arguments.get("start", ["0"])[0])
+        max_results = int(arguments.get("max_results", ["10"])[0])
+        id_list = [
+            paper_id
+            for paper_id in arguments.get("id_list", [""])[0].split(",")
+            if paper_id
+        ]
+
+        if id_list:
+            papers = fake_papers(id_list)
+            total_results = len(papers)
+        else:
+            stop = min(start + max_results, self.total_results)
+            papers = fake_papers([f"2301.{row:05d}" for row in range(start, stop)])
+            ## Newest first, like the sort by last updated date used by storage.
+            papers["updated"] = pd.Timestamp("2024-01-01", tz="UTC") - pd.to_timedelta(
+                range(start, stop), unit="min"
+            )
+            total_results = self.total_results
+            start = 0
+
+        papers = papers.iloc[start : start + max_results]
+        entries = "".join(entry(paper) for paper in papers.itertuples())
+
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<feed xmlns="http://www.w3.org/2005/Atom" '
+            'xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" '
+            'xmlns:arxiv="http://arxiv.org/schemas/atom">'
+            "<title>ArXiv Query</title><id>http://arxiv.org/api/fake</id>"
+            "<updated>2024-01-01T00:00:00Z</updated>"
+            f"<opensearch:totalResults>{total_results}</opensearch:totalResults>"
+            f"<opensearch:startIndex>{arguments.get('start', ['0'])[0]}</opensearch:startIndex>"
+            f"<opensearch:itemsPerPage>{max_results}</opensearch:itemsPerPage>"
+            f"{entries}</feed>"
+        )
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server._lock:
+                    server.request_times.append(time.monotonic())
+                    request_number = len(server.request_times)
+                if server.latency:
+                    time.sleep(server.latency)
+
+                if server.fail_every and request_number % server.fail_every == 0:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+
+                body = server.feed(parse_qs(urlparse(self.path).query)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/atom+xml")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def entry(paper):
+    """Returns the Atom entry of one row of fake_papers."""
+    paper_id = paper.id if "v" in paper.id else paper.id + "v1"
+    timestamp = paper.updated.strftime("%Y-%m-%dT%H:%M:%SZ")
+    authors = "".join(
+        f"<author><name>{escape(author)}</name></author>" for author in paper.authors
+    )
+    categories = "".join(
+        f'<category term={quoteattr(tag)} scheme="http://arxiv.org/schemas/atom"/>'
+        for tag in paper.categories
+    )
+
+    return (
+        f"<entry><id>http://arxiv.org/abs/{paper_id}</id>"
+        f"<updated>{timestamp}</updated><published>{timestamp}</published>"
+        f"<title>{escape(paper.title)}</title><summary>{escape(paper.abstract)}</summary>"
+        f"{authors}"
+        f'<link href="http://arxiv.org/abs/{paper_id}" rel="alternate" type="text/html"/>'
+        f"<arxiv:primary_category term={quoteattr(paper.categories[0])}/>"
+        f"{categories}</entry>"
+    )
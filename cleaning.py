@@ -1,20 +1,38 @@
+import os
 import regex
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-import json
-import sentence_transformers.util
+import taxonomy
 import numpy as np
-from sklearn.preprocessing import MultiLabelBinarizer
 from sklearn.base import BaseEstimator, TransformerMixin
 
 
 class TextCleaner(BaseEstimator, TransformerMixin):
+    """Returns the list of cleaned 'title abstract' document strings of a metadata frame. Large frames are
+    cleaned across n_jobs processes, in pool if one is given, see cleaning_pool, and otherwise in a pool
+    started for the call."""
+
+    def __init__(self, n_jobs=1, pool=None) -> None:
+        super().__init__()
+        self.n_jobs = n_jobs
+        self.pool = pool
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
-        doc_strings = (
-            X.title.apply(cleanse) + " " + X.abstract.apply(cleanse)
-        ).to_list()
+        with (
+            nullcontext(self.pool)
+            if self.pool is not None
+            else cleaning_pool(self.n_jobs)
+        ) as pool:
+            titles = cleanse_all(X.title, n_jobs=self.n_jobs, pool=pool)
+            abstracts = cleanse_all(X.abstract, n_jobs=self.n_jobs, pool=pool)
+        doc_strings = [
+            title + " " + abstract for title, abstract in zip(titles, abstracts)
+        ]
 
         return doc_strings
 
@@ -25,30 +43,35 @@ class FullTextCleaner(BaseEstimator, TransformerMixin):
     2. The msc tag list has been translated to english.
     """
 
+    def __init__(self, n_jobs=1) -> None:
+        super().__init__()
+        self.n_jobs = n_jobs
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
-        X.metadata.title = X.metadata.title.apply(cleanse)
-        X.metadata.abstract = X.metadata.abstract.apply(cleanse)
-        X.metadata.msc_tags[X.metadata.msc_tags.notna()] = X.metadata.msc_tags[
-            X.metadata.msc_tags.notna()
-        ].apply(list_mapper, dictionary=msc_tags())
+        with cleaning_pool(self.n_jobs) as pool:
+            X.metadata.title = cleanse_all(
+                X.metadata.title, n_jobs=self.n_jobs, pool=pool
+            )
+            X.metadata.abstract = cleanse_all(
+                X.metadata.abstract, n_jobs=self.n_jobs, pool=pool
+            )
+        X.metadata.msc_tags[X.metadata.msc_tags.notna()] = taxonomy.map_lists(
+            X.metadata.msc_tags[X.metadata.msc_tags.notna()], msc_tags()
+        )
         X.metadata["doc_strings"] = X.metadata.title + " " + X.metadata.abstract
 
         return X
 
 
 def arxiv_subjects():
-    with open("./data/arxiv_subjects.json", "r") as file:
-        dictionary = file.read()
-        return json.loads(dictionary)
+    return taxonomy.arxiv_subjects()
 
 
 def msc_tags():
-    with open("./data/msc.json", "r") as file:
-        dictionary = file.read()
-        return json.loads(dictionary)
+    return taxonomy.msc_tags()
 
 
 def list_mapper(item_list, dictionary):
@@ -80,6 +103,8 @@ def split_categories(raw_metadata):
 
 
 def OHE_arxiv_subjects(metadata):
+    from sklearn.preprocessing import MultiLabelBinarizer
+
     mlb = MultiLabelBinarizer()
     OHE_subject_array = mlb.fit_transform(metadata.arxiv_subjects)
 
@@ -94,48 +119,46 @@ def OHE_arxiv_subjects(metadata):
 
 
 def extract_arxiv_subjects(raw_metadata):
-    def get_arxiv_subjects_from_cats(categories):
-        return [tag for tag in categories if tag in arxiv_subjects().keys()]
-
-    return raw_metadata.categories.apply(get_arxiv_subjects_from_cats)
+    return taxonomy.filter_lists(raw_metadata.categories, taxonomy.arxiv_subject_tags())
 
 
 def extract_msc_tags(raw_metadata):
     ## Check the last entry for 5 digit msc tags only.
 
-    msc_tags = raw_metadata.categories.apply(lambda x: find_msc(x[-1]))
+    msc_tags = raw_metadata.categories.str[-1].map(find_msc)
 
-    msc_tags = msc_tags.apply(lambda x: np.nan if len(x) == 0 else x)
+    msc_tags = msc_tags.map(lambda x: np.nan if len(x) == 0 else x)
 
     return msc_tags
 
 
 #### LATEX CLEANING UTILITIES
 
+LATEX_ACCENT_BRACED = regex.compile(r"\\[\'\"\^\`H\~ckl=bdruvtoi]\{([a-z])\}")
+LATEX_ENV = regex.compile(r"\\[a-z]{2,}{[^{}]+?}")
+LATEX_ACCENT = regex.compile(r"\\[\'\"\^\`H\~ckl=bdruvtoi]([a-z])")
+LATEX_MATH = regex.compile(r"\s(\$\$?)[^\$]*?\1\S*")
+
 
 ## 1. Latin-ize latex accents enclosed in brackets
 def remove_latex_accents(string):
-    accent = r"\\[\'\"\^\`H\~ckl=bdruvtoi]\{([a-z])\}"
     replacement = r"\1"
 
-    string = regex.sub(accent, replacement, string)
+    string = LATEX_ACCENT_BRACED.sub(replacement, string)
     return string
 
 
 ## 2. Remove latex environments
 def remove_env(string):
-    env = r"\\[a-z]{2,}{[^{}]+?}"
-
-    string = regex.sub(env, "", string)
+    string = LATEX_ENV.sub("", string)
     return string
 
 
 ## 3. Latin-ize non-{} enclosed latex accents:
 def remove_accents(string):
-    accent = r"\\[\'\"\^\`H\~ckl=bdruvtoi]([a-z])"
     replacement = r"\1"
 
-    string = regex.sub(accent, replacement, string)
+    string = LATEX_ACCENT.sub(replacement, string)
     return string
 
 
@@ -143,20 +166,76 @@ def remove_accents(string):
 
 
 def remove_latex(string):
-    latex = r"\s(\$\$?)[^\$]*?\1\S*"
-    string = regex.sub(latex, " LATEX ", string)
+    string = LATEX_MATH.sub(" LATEX ", string)
     return string
 
 
 def cleanse(string):
     string = string.replace("\n", " ")
-    string = remove_latex_accents(string)
-    string = remove_env(string)
-    string = remove_accents(string)
-    string = remove_latex(string)
+
+    ## Every pass needs a character that most strings lack, skip the passes that cannot match.
+    if "\\" in string:
+        if "{" in string:
+            string = remove_latex_accents(string)
+            string = remove_env(string)
+        string = remove_accents(string)
+    if "$" in string:
+        string = remove_latex(string)
+
     return string
 
 
+## Smallest chunk worth the cost of sending it to a worker process.
+MIN_CHUNK_SIZE = 250
+
+
+def cleanse_all(strings, n_jobs=1, chunk_size=None, pool=None):
+    """Applies cleanse to every string in strings, returning a list in the same order.
+
+    Args:
+        strings: iterable of strings, e.g. a column of titles or abstracts.
+        n_jobs: number of worker processes, None for one per core. Inputs of more than one chunk are split into
+        chunks and cleaned in a process pool. Defaults to 1, which cleans in the calling process.
+        chunk_size: number of strings sent to a worker at a time. Defaults to None, which splits the input into
+        about four chunks per worker of at least MIN_CHUNK_SIZE strings.
+        pool: ProcessPoolExecutor to clean in, see cleaning_pool, so that several columns share one pool.
+        Defaults to None, which starts a pool for this call when one is needed.
+    """
+    strings = list(strings)
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = max(MIN_CHUNK_SIZE, -(-len(strings) // (4 * n_jobs)))
+    if n_jobs == 1 or len(strings) <= chunk_size:
+        return [cleanse(string) for string in strings]
+
+    chunks = [
+        strings[start : start + chunk_size]
+        for start in range(0, len(strings), chunk_size)
+    ]
+    with cleaning_pool(n_jobs) if pool is None else nullcontext(pool) as pool:
+        cleaned_chunks = pool.map(_cleanse_chunk, chunks)
+
+        return [string for chunk in cleaned_chunks for string in chunk]
+
+
+def cleaning_pool(n_jobs):
+    """Returns a ProcessPoolExecutor of n_jobs workers to pass to cleanse_all, or an empty context if n_jobs is
+    1. None starts one worker per core."""
+    if n_jobs == 1:
+        return nullcontext(None)
+
+    ## Workers are spawned rather than forked: cleaning runs in a background thread of library builds
+    ## while the main thread encodes, and forking a process that has started torch's thread pools can
+    ## deadlock.
+    return ProcessPoolExecutor(
+        max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def _cleanse_chunk(strings):
+    return [cleanse(string) for string in strings]
+
+
 ##
 
 
@@ -170,49 +249,38 @@ def find_hyph(text):
         return list(set(keywords))
 
 
+MSC_CODE = taxonomy.MSC_CODE
+
+
 def find_msc(msc_string):
-    five_digit_pattern = r"\b\d{2}[0-9a-zA-Z]{3}\b"
-    five_digit_tags = regex.findall(five_digit_pattern, msc_string)
-    return five_digit_tags
+    return taxonomy.find_msc(msc_string)
 
 
 def cats_to_msc(cat_list):
-    out = []
-    for tag in find_msc(cat_list):
-        if tag in msc_tags().keys():
-            out.append(msc_tags()[tag])
-        else:
-            continue
-    if out == []:
-        return None
-    else:
-        return out
+    return list_mapper(find_msc(cat_list), msc_tags())
 
 
 ##
 
 
 def msc_encoded_dict():
-    encoded_tags = pd.read_parquet("./data/msc_mini_embeddings.parquet").to_numpy()
-    return {k: v for (k, v) in zip(msc_tags().values(), encoded_tags)}
+    return taxonomy.msc_encoded_dict()
 
 
 def doc_encoded_dict():
-    library_embeddings = pd.read_parquet("./data/APSP_mini_vec.parquet")
-
-    docs = library_embeddings.docs.to_list()
-    encoded_docs = library_embeddings.vecs.to_numpy()
-
-    return {k: v for (k, v) in zip(docs, encoded_docs)}
+    return taxonomy.doc_encoded_dict()
 
 
 def score_tags(processed_arxiv_row):
+    import sentence_transformers.util
+
     tag_list = processed_arxiv_row.msc_tags
     title_plus_abstract = processed_arxiv_row.docs
 
     if tag_list is None:
         return None
-    embedded_msc_tags = [msc_encoded_dict()[tag] for tag in tag_list]
+    tag_to_embedding = msc_encoded_dict()
+    embedded_msc_tags = [tag_to_embedding[tag] for tag in tag_list]
 
     return sentence_transformers.util.semantic_search(
         query_embeddings=doc_encoded_dict()[title_plus_abstract],
@@ -0,0 +1,140 @@
+import zlib
+import numpy as np
+
+## Universal hashing modulo a prime just above 2**32, so that a * hash + b never overflows uint64.
+PRIME = 4294967311
+
+
+class NearDuplicateFilter:
+    """Finds near-duplicate documents in a stream with MinHash signatures and LSH banding.
+
+    Each document is reduced to the set of its word shingles and summarized by num_perm MinHash values, whose
+    agreement rate estimates the Jaccard similarity of two shingle sets. Signatures are split into bands, and
+    only documents sharing all values of some band are compared, so finding the duplicates of a document
+    costs about the same however many documents have been seen. A document is a duplicate if its estimated
+    similarity to an earlier document is at least threshold.
+
+    Args:
+        threshold: estimated Jaccard similarity above which two documents are duplicates. Defaults to 0.9.
+        num_perm: number of MinHash values per document. Defaults to 128.
+        shingle_size: number of consecutive words per shingle. Defaults to 3.
+        seed: seed of the hash functions. Defaults to 0.
+    """
+
+    def __init__(self, threshold=0.9, num_perm=128, shingle_size=3, seed=0) -> None:
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = lsh_parameters(threshold, num_perm)
+
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2**32, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 2**32, size=num_perm, dtype=np.uint64)
+        self._buckets = [{} for _ in range(self.bands)]
+        self._keys = []
+        self._signatures = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def signatures(self, texts, batch_size=256):
+        """Returns the (len(texts), num_perm) uint32 MinHash signatures of texts."""
+        signatures = np.empty((len(texts), self.num_perm), dtype=np.uint32)
+        for start in range(0, len(texts), batch_size):
+            shingle_sets = [
+                shingle_hashes(text, self.shingle_size)
+                for text in texts[start : start + batch_size]
+            ]
+            lengths = np.array([len(hashes) for hashes in shingle_sets])
+            hashes = np.concatenate(shingle_sets)[:, np.newaxis]
+            permuted = (hashes * self._a + self._b) % PRIME
+            offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+            signatures[start : start + len(shingle_sets)] = np.minimum.reduceat(
+                permuted, offsets, axis=0
+            )
+
+        return signatures
+
+    def add(self, keys, signatures):
+        """Indexes documents as seen, without checking them for duplicates."""
+        for key, signature in zip(keys, signatures):
+            for band, bucket in zip(self._bands(signature), self._buckets):
+                bucket.setdefault(band, []).append(len(self._keys))
+            self._keys.append(key)
+            self._signatures.append(signature)
+
+    def duplicate_of(self, signature):
+        """Returns (key, similarity) of the most similar indexed document at or above threshold, or None."""
+        candidates = set()
+        for band, bucket in zip(self._bands(signature), self._buckets):
+            candidates.update(bucket.get(band, ()))
+        if not candidates:
+            return None
+
+        candidates = sorted(candidates)
+        similarities = (
+            np.stack([self._signatures[position] for position in candidates])
+            == signature
+        ).mean(axis=1)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+
+        return self._keys[candidates[best]], float(similarities[best])
+
+    def filter(self, keys, texts):
+        """Checks a batch of documents against every document seen so far, and against each other in order,
+        indexing the ones that are kept.
+
+        Returns:
+            Tuple (keep, signatures, merges): a boolean array marking the documents that are not duplicates,
+            the signatures of all documents, and a list of (key, duplicate_of, similarity) tuples, one per
+            dropped document, naming the kept document it duplicates.
+        """
+        signatures = self.signatures(texts)
+        keep = np.ones(len(keys), dtype=bool)
+        merges = []
+        for position, (key, text, signature) in enumerate(zip(keys, texts, signatures)):
+            match = self.duplicate_of(signature) if text.strip() else None
+            if match is None:
+                self.add([key], [signature])
+            else:
+                keep[position] = False
+                merges.append((key, *match))
+
+        return keep, signatures, merges
+
+    def _bands(self, signature):
+        return [
+            signature[band * self.rows : (band + 1) * self.rows].tobytes()
+            for band in range(self.bands)
+        ]
+
+
+def lsh_parameters(threshold, num_perm):
+    """Returns the number of bands and rows per band, with bands * rows == num_perm, whose LSH similarity
+    threshold (1 / bands) ** (1 / rows) is closest to threshold.
+    """
+    splits = [
+        (num_perm // rows, rows)
+        for rows in range(1, num_perm + 1)
+        if num_perm % rows == 0
+    ]
+    return min(
+        splits, key=lambda split: abs((1 / split[0]) ** (1 / split[1]) - threshold)
+    )
+
+
+def shingle_hashes(text, shingle_size=3):
+    """Returns the distinct crc32 hashes of the shingle_size-word shingles of text, lowercased, as uint64."""
+    words = text.lower().split()
+    shingles = {
+        " ".join(words[start : start + shingle_size])
+        for start in range(max(1, len(words) - shingle_size + 1))
+    }
+
+    return np.fromiter(
+        (zlib.crc32(shingle.encode()) for shingle in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
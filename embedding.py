@@ -1,5 +1,8 @@
 import cleaning as clean
-from sentence_transformers import SentenceTransformer, util
+from encoders import get_encoder, encode, EncodingPool
+from index import normalize
+from embedding_cache import default_cache
+from quantize import write_quantized_embeddings
 import pandas as pd
 import numpy as np
 import json
@@ -8,18 +11,20 @@ import os
 
 
 class Embedder(BaseEstimator, TransformerMixin):
-    """Takes a list of clean strings and outputs a numpy array of their embeddings generated by the ST model model_name."""
+    """Takes a list of clean strings and outputs a numpy array of their embeddings generated by the ST model model_name.
+    If an EmbeddingCache is given, only strings missing from it are sent to the model.
+    """
 
-    def __init__(self, model_name) -> None:
+    def __init__(self, model_name, cache=None) -> None:
         super().__init__()
         self.model_name = model_name
+        self.cache = cache
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
-        encoder = SentenceTransformer(self.model_name)
-        embedded_documents = encoder.encode(sentences=X)
+        embedded_documents = encode(self.model_name, X, cache=self.cache)
 
         return embedded_documents
 
@@ -37,6 +42,9 @@ class FullEmbedder(BaseEstimator, TransformerMixin):
         model_name=None,
         load_from_file=False,
         path_to_embeddings=None,
+        cache=None,
+        storage_dtype="float32",
+        n_workers=None,
     ):
         """Either generates embeddings from an clean ArXivData instance or loads embeddings from file.
 
@@ -46,6 +54,12 @@ class FullEmbedder(BaseEstimator, TransformerMixin):
             model_name: Sentence transformer model used to generate embeddings. Defaults to None.
             load_from_file: Boolean used to specify whether to calculate embeddings or load from file. Defaults to False.
             path_to_embeddings: path to the location to save embeddings to or load embeddings from. Defaults to None.
+            cache: EmbeddingCache consulted before encoding. Defaults to None, which uses the process-wide cache,
+            as get_recs and library.main do. Pass False to always encode.
+            storage_dtype: 'float16' or 'int8' to also save a quantized copy of the normalized embeddings next to
+            path_to_embeddings. Defaults to 'float32'.
+            n_workers: number of worker processes encoding length-bucketed batches, see encoders.EncodingPool.
+            Defaults to None, which encodes with one call to the model in this process.
 
         Raises:
             Exception: Raises exception if the load_from_file is True without a specified path to load from.
@@ -65,9 +79,19 @@ class FullEmbedder(BaseEstimator, TransformerMixin):
                     "You must specify the sentence transformer model to use."
                 )
 
+            if cache is None:
+                cache = default_cache()
+            elif cache is False:
+                cache = None
+
             doc_strings = (X.metadata.doc_strings).to_list()
-            model = SentenceTransformer(model_name)
-            embeddings = model.encode(doc_strings, show_progress_bar=True)
+            if n_workers:
+                with EncodingPool(model_name, n_workers=n_workers) as pool:
+                    embeddings = encode(model_name, doc_strings, cache=cache, pool=pool)
+            else:
+                embeddings = encode(
+                    model_name, doc_strings, cache=cache, show_progress_bar=True
+                )
             X.embeddings = embeddings
 
             ## Save the embeddings to the specified path, or, if no path is specified, use the default path
@@ -85,43 +109,75 @@ class FullEmbedder(BaseEstimator, TransformerMixin):
 
             embeddings_df.to_feather(path_to_embeddings)
 
+            if storage_dtype != "float32":
+                write_quantized_embeddings(
+                    os.path.splitext(path_to_embeddings)[0],
+                    normalize(embeddings),
+                    storage_dtype,
+                )
+
             return X
 
 
 class ComputeMSCLabels(BaseEstimator, TransformerMixin):
+    """Scores the MSC tags of each paper by the cosine similarity between the paper's embedding and the
+    embedding of the tag's name.
+
+    The document embeddings are read once and all (paper, tag) pairs are scored in one batched product.
+    The result is a long-format frame with one row per pair: 'row' is the position of the paper in X,
+    followed by 'tag' and 'score', sorted by row and then by decreasing score.
+    """
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None, path_to_embeddings=None):
-        tag_to_embedding_dict = clean.msc_encoded_dict()
+        doc_embeddings = pd.read_feather(path_to_embeddings).to_numpy()
+
+        return score_tags_batch(doc_embeddings, X.msc_tags, clean.msc_encoded_dict())
+
+
+def score_tags_batch(doc_embeddings, tag_lists, tag_to_embedding, chunk_size=65536):
+    """Computes the cosine similarity of every document with each of its tags.
+
+    The tag lists are flattened CSR-style into parallel arrays of document rows and tag codes, so every
+    pair is scored by one gathered row-wise dot product per chunk of chunk_size pairs.
 
-        X["scored_tags"] = np.nan
+    Args:
+        doc_embeddings: array of shape (n_docs, dim) of document embeddings.
+        tag_lists: series of n_docs lists of tag names, or NaN for untagged documents.
+        tag_to_embedding: mapping of tag names to their embeddings. Tags missing from it are skipped.
+        chunk_size: number of pairs scored at a time. Defaults to 65536.
 
-        X_tagged_rows = X[X.msc_tags.notna()]
+    Returns:
+        DataFrame with columns 'row', 'tag' and 'score'.
+    """
+    tag_names = pd.Index(list(tag_to_embedding.keys()))
+    tag_matrix = normalize(np.stack(list(tag_to_embedding.values())))
 
-        X_tagged_rows["tag_embeddings"] = X_tagged_rows.msc_tags.apply(
-            clean.list_mapper, dictionary=tag_to_embedding_dict
-        )
-        tag_scores = X_tagged_rows.apply(
-            self.get_tag_semantic_scores, path_to_embeddings=path_to_embeddings, axis=1
-        )
-        X.scored_tags[X.metadata.msc_tags.notna()] = tag_scores
+    pairs = tag_lists.reset_index(drop=True).explode().dropna()
+    pairs = pairs[pairs.isin(tag_names)]
+    rows = pairs.index.to_numpy()
+    tag_codes = tag_names.get_indexer(pairs)
 
-        return X
+    scores = np.empty(len(pairs), dtype=np.float32)
+    for start in range(0, len(pairs), chunk_size):
+        chunk_rows = rows[start : start + chunk_size]
+        docs = normalize(doc_embeddings[chunk_rows])
+        tags = tag_matrix[tag_codes[start : start + chunk_size]]
+        scores[start : start + chunk_size] = np.einsum("ij,ij->i", docs, tags)
 
-    def get_tag_semantic_scores(self, metadata_row, path_to_embeddings):
-        embeddings = pd.read_feather(path_to_embeddings).to_numpy()
-        results = util.semantic_search(
-            query_embeddings=list(embeddings[metadata_row.doc_strings.index, :]),
-            corpus_embeddings=metadata_row.tag_embeddings,
-            top_k=50,
-        )
+    scored_tags = pd.DataFrame(
+        {"row": rows, "tag": tag_names[tag_codes], "score": scores}
+    )
 
-        return results[0]
+    return scored_tags.sort_values(
+        ["row", "score"], ascending=[True, False], kind="stable"
+    ).reset_index(drop=True)
 
 
 def generate_tag_embeddings(model_name, path_to_tag_dict, path_to_save_embeddings):
-    model = SentenceTransformer(model_name)
+    model = get_encoder(model_name)
     with open(path_to_tag_dict, "r") as file:
         dict_string = file.read()
         tag_dict = json.loads(dict_string)
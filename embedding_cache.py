@@ -0,0 +1,144 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+
+
+class EmbeddingCache:
+    """A persistent cache of sentence embeddings stored in SQLite.
+
+    Entries are keyed by the model name and the SHA-256 hash of the cleaned document string, so the same
+    text is only ever encoded once per model. Once the cache holds more than max_entries embeddings the
+    least recently used ones are deleted.
+    """
+
+    def __init__(self, path_to_cache, max_entries=200_000) -> None:
+        self.path_to_cache = path_to_cache
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path_to_cache)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path_to_cache, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                key TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, key)
+            )""")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._connection.commit()
+
+    def get_many(self, model_name, sentences):
+        """Looks up the cached embeddings of sentences.
+
+        Returns:
+            dict mapping the position of each cached sentence in sentences to its float32 embedding.
+        """
+        keys = [text_key(sentence) for sentence in sentences]
+        found = {}
+        with self._lock:
+            unique_keys = list(set(keys))
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start : start + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(chunk))})",
+                    [model_name, *chunk],
+                ).fetchall()
+                found.update(rows)
+
+            if found:
+                self._connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND key = ?",
+                    [(time.time(), model_name, key) for key in found],
+                )
+                self._connection.commit()
+
+            cached = {
+                position: np.frombuffer(found[key], dtype=np.float32)
+                for position, key in enumerate(keys)
+                if key in found
+            }
+            self.hits += len(cached)
+            self.misses += len(keys) - len(cached)
+
+        return cached
+
+    def put_many(self, model_name, sentences, embeddings):
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, key, vector, last_used) VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        model_name,
+                        text_key(sentence),
+                        np.asarray(embedding, dtype=np.float32).tobytes(),
+                        now,
+                    )
+                    for sentence, embedding in zip(sentences, embeddings)
+                ],
+            )
+            self._evict()
+            self._connection.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+        }
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM embeddings")
+            self._connection.commit()
+
+    def _evict(self):
+        excess = (
+            self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            - self.max_entries
+        )
+        if excess > 0:
+            self._connection.execute(
+                """DELETE FROM embeddings WHERE rowid IN (
+                    SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?
+                )""",
+                (excess,),
+            )
+
+
+def text_key(sentence):
+    return hashlib.sha256(sentence.encode("utf-8")).hexdigest()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache():
+    """Returns the process-wide cache stored at ./data/cache/embeddings.sqlite."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache("./data/cache/embeddings.sqlite")
+
+        return _default_cache
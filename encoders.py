@@ -0,0 +1,319 @@
+import os
+import threading
+import multiprocessing
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+
+class EncoderRegistry:
+    """Keeps sentence transformer models resident so that each model is loaded at most once per process.
+
+    Models are evicted in least recently used order once more than max_models are loaded, or once the
+    combined size of their parameters exceeds max_bytes.
+    """
+
+    def __init__(self, max_models=2, max_bytes=None) -> None:
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+    def get(self, model_name):
+        """Returns the loaded model model_name, loading it on first use.
+
+        Args:
+            model_name: name or path of the sentence transformer model.
+
+        Returns:
+            SentenceTransformer instance shared by every caller in this process.
+        """
+        with self._lock:
+            if model_name in self._models:
+                self._models.move_to_end(model_name)
+                return self._models[model_name]
+
+            ## Imported here so that processes which never encode do not pay for loading torch.
+            from sentence_transformers import SentenceTransformer
+
+            model = SentenceTransformer(model_name)
+            self._models[model_name] = model
+            self._sizes[model_name] = model_size(model)
+            self._evict(keep=model_name)
+
+            return model
+
+    def register(self, model_name, model):
+        """Makes model available under model_name without loading it from disk, e.g. a stand-in encoder for
+        running the pipeline offline. model needs an encode method like SentenceTransformer.encode.
+        """
+        with self._lock:
+            self._models[model_name] = model
+            self._models.move_to_end(model_name)
+            self._sizes[model_name] = model_size(model)
+            self._evict(keep=model_name)
+
+    def warm_up(self, model_names):
+        """Loads each model in model_names and runs one forward pass so the first real request
+        does not pay for lazy initialization.
+        """
+        for model_name in model_names:
+            with self._lock:
+                loaded = model_name in self._models
+            if not loaded:
+                self.get(model_name).encode(sentences=["warm up"])
+
+    def evict(self, model_name):
+        with self._lock:
+            self._models.pop(model_name, None)
+            self._sizes.pop(model_name, None)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._sizes.clear()
+
+    def loaded(self):
+        with self._lock:
+            return list(self._models.keys())
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def _evict(self, keep):
+        ## Drop least recently used models until both budgets are met, never evicting the model just requested.
+        while len(self._models) > 1 and (
+            len(self._models) > self.max_models
+            or (self.max_bytes is not None and self.total_bytes() > self.max_bytes)
+        ):
+            oldest = next(iter(self._models))
+            if oldest == keep:
+                break
+            self.evict(oldest)
+
+
+def model_size(model):
+    """Returns the number of bytes taken up by the parameters of a torch model."""
+    return sum(
+        parameter.numel() * parameter.element_size() for parameter in model.parameters()
+    )
+
+
+registry = EncoderRegistry()
+
+
+def get_encoder(model_name):
+    return registry.get(model_name)
+
+
+def warm_up(*model_names):
+    registry.warm_up(model_names)
+
+
+def encode(model_name, sentences, cache=None, pool=None, **encode_kwargs):
+    """Encodes sentences with the shared model model_name, only sending sentences missing from cache to the model.
+
+    Args:
+        model_name: name or path of the sentence transformer model.
+        sentences: list of cleaned document strings.
+        cache: optional EmbeddingCache consulted before encoding and updated with the new embeddings.
+        pool: optional EncodingPool for model_name that encodes in length-bucketed batches across worker
+        processes instead of with one call to the shared model.
+        encode_kwargs: passed on to SentenceTransformer.encode.
+
+    Returns:
+        float32 array of shape (len(sentences), dim) in the order of sentences.
+    """
+
+    def model_encode(sentences):
+        if pool is not None:
+            return pool.encode(sentences, **encode_kwargs)
+        return get_encoder(model_name).encode(sentences=sentences, **encode_kwargs)
+
+    if cache is None:
+        return model_encode(sentences)
+
+    sentences = list(sentences)
+    if not sentences:
+        return model_encode(sentences)
+
+    embeddings = cache.get_many(model_name, sentences)
+
+    ## Encode each distinct missing text once, even if it appears several times in sentences.
+    missing = list(
+        dict.fromkeys(
+            sentence
+            for position, sentence in enumerate(sentences)
+            if position not in embeddings
+        )
+    )
+    if missing:
+        encoded = model_encode(missing)
+        cache.put_many(model_name, missing, encoded)
+        encoded_by_sentence = dict(zip(missing, encoded))
+        for position, sentence in enumerate(sentences):
+            if position not in embeddings:
+                embeddings[position] = encoded_by_sentence[sentence]
+
+    return np.stack(
+        [embeddings[position] for position in range(len(sentences))]
+    ).astype(np.float32)
+
+
+class EncodingPool:
+    """Encodes documents with a sentence transformer model in length-bucketed batches spread over a pool of
+    worker processes, each holding its own copy of the model.
+
+    Documents are sorted by length and cut into batches whose padded size, the number of documents times
+    the length of the longest one, stays within token_budget, so that short documents are not padded to
+    the longest abstract in the corpus and batches of short documents hold more of them. Lengths are
+    estimated by word count, since the cleaned texts are whitespace separated and the tokenizer lives in
+    the workers. Batches are handed out longest first, and the embeddings are returned in the order of the
+    input.
+
+    Args:
+        model_name: name or path of the sentence transformer model.
+        n_workers: number of worker processes. With 1 the batches are encoded in this process with the shared
+        model. Defaults to the number of cores.
+        threads_per_worker: number of torch threads of each worker. Defaults to the number of cores divided
+        by n_workers.
+        token_budget: maximum padded size of a batch, in words. Defaults to 8192.
+        max_batch_size: maximum number of documents per batch. Defaults to 128.
+        max_length: length at which documents are assumed to be truncated by the model, in words. Defaults
+        to 512.
+        model: optional object with an encode method like SentenceTransformer.encode, used in place of
+        loading model_name, see EncoderRegistry.register. It is pickled into every worker. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        n_workers=None,
+        threads_per_worker=None,
+        token_budget=8192,
+        max_batch_size=128,
+        max_length=512,
+        model=None,
+    ) -> None:
+        self.model_name = model_name
+        self.n_workers = n_workers or os.cpu_count()
+        self.threads_per_worker = threads_per_worker or max(
+            1, os.cpu_count() // self.n_workers
+        )
+        self.token_budget = token_budget
+        self.max_batch_size = max_batch_size
+        self.max_length = max_length
+        self.model = model
+        self._executor = None
+
+        if model is not None:
+            registry.register(model_name, model)
+
+    def encode(self, sentences, **encode_kwargs):
+        """Encodes sentences.
+
+        Args:
+            sentences: list of cleaned document strings.
+            encode_kwargs: passed on to SentenceTransformer.encode, except batch_size and show_progress_bar,
+            which are set per batch.
+
+        Returns:
+            float32 array of shape (len(sentences), dim) in the order of sentences.
+        """
+        sentences = list(sentences)
+        for key in ["batch_size", "show_progress_bar"]:
+            encode_kwargs.pop(key, None)
+        if not sentences:
+            return np.empty((0, 0), dtype=np.float32)
+
+        batches = self.batches(sentences)
+        if self.n_workers == 1:
+            results = (
+                encode_batch(
+                    self.model_name, [sentences[i] for i in batch], encode_kwargs
+                )
+                for batch in batches
+            )
+        else:
+            executor = self._start()
+            results = executor.map(
+                encode_batch,
+                [self.model_name] * len(batches),
+                [[sentences[i] for i in batch] for batch in batches],
+                [encode_kwargs] * len(batches),
+            )
+
+        embeddings = None
+        for batch, encoded in zip(batches, results):
+            if embeddings is None:
+                embeddings = np.empty((len(sentences), encoded.shape[1]), np.float32)
+            embeddings[batch] = encoded
+
+        return embeddings
+
+    def batches(self, sentences):
+        """Returns the batches of sentences as arrays of positions in sentences, longest documents first."""
+        lengths = np.array(
+            [min(len(sentence.split()), self.max_length) for sentence in sentences]
+        )
+        ## Stable, so that documents of equal length keep their relative order.
+        order = np.argsort(-lengths, kind="stable")
+
+        batches = []
+        start = 0
+        while start < len(order):
+            ## The first document of a batch is its longest, and sets its padded length.
+            padded_length = max(1, lengths[order[start]])
+            size = min(self.max_batch_size, max(1, self.token_budget // padded_length))
+            batches.append(order[start : start + size])
+            start += size
+
+        return batches
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _start(self):
+        if self._executor is None:
+            ## Workers are spawned rather than forked, since forking a process that has started torch's
+            ## thread pools can deadlock.
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=start_worker,
+                initargs=(self.model_name, self.threads_per_worker, self.model),
+            )
+        return self._executor
+
+
+def start_worker(model_name, n_threads, model):
+    """Sets up an EncodingPool worker process: limits its torch threads and loads its copy of the model."""
+    import torch
+
+    torch.set_num_threads(n_threads)
+    if model is not None:
+        registry.register(model_name, model)
+    else:
+        registry.get(model_name)
+
+
+def encode_batch(model_name, sentences, encode_kwargs):
+    return np.asarray(
+        get_encoder(model_name).encode(
+            sentences=sentences,
+            batch_size=len(sentences),
+            show_progress_bar=False,
+            **encode_kwargs,
+        ),
+        dtype=np.float32,
+    )
@@ -0,0 +1,133 @@
+import os
+import numpy as np
+import pandas as pd
+from taxonomy import find_msc
+from index import unique_temporary_path
+
+
+class FilterIndex:
+    """Indexes over the arXiv subjects and MSC codes of the papers in a library.
+
+    There are few subject tags and each is carried by many papers, so every subject owns a bit-packed row
+    marking its papers. There are thousands of MSC codes, each carried by few papers, so they are stored as
+    an inverted index: the sorted codes, and CSR offsets into the concatenated row numbers of their papers.
+    Filters are resolved with a handful of vectorized operations, without touching the metadata.
+    """
+
+    def __init__(
+        self, n_papers, subject_tags, subject_bits, msc_codes, msc_offsets, msc_rows
+    ) -> None:
+        self.n_papers = n_papers
+        self.subject_tags = subject_tags
+        self.subject_bits = subject_bits
+        self.msc_codes = msc_codes
+        self.msc_offsets = msc_offsets
+        self.msc_rows = msc_rows
+
+    @classmethod
+    def build(cls, categories):
+        """Builds the bitmaps from the 'categories' column of a library's metadata.
+
+        MSC codes are read from the last category entry, as in cleaning.extract_msc_tags, and every other
+        entry is treated as an arXiv subject tag.
+        """
+        categories = categories.reset_index(drop=True)
+        subjects = categories.map(lambda tags: list(tags[:-1]) if len(tags) else [])
+        last = categories.map(lambda tags: tags[-1] if len(tags) else "")
+        subjects = subjects + last.map(
+            lambda tag: [] if not tag or find_msc(tag) else [tag]
+        )
+        msc = last.map(find_msc)
+
+        subject_tags, subject_offsets, subject_rows = postings(subjects)
+        subject_bits = np.zeros(
+            (len(subject_tags), (len(categories) + 7) // 8), dtype=np.uint8
+        )
+        for tag in range(len(subject_tags)):
+            rows = subject_rows[subject_offsets[tag] : subject_offsets[tag + 1]]
+            marks = np.zeros(len(categories), dtype=bool)
+            marks[rows] = True
+            subject_bits[tag] = np.packbits(marks)
+
+        return cls(len(categories), subject_tags, subject_bits, *postings(msc))
+
+    def save(self, path_to_index):
+        temporary_path = unique_temporary_path(path_to_index)
+        with open(temporary_path, "wb") as file:
+            np.savez(
+                file,
+                n_papers=self.n_papers,
+                subject_tags=self.subject_tags,
+                subject_bits=self.subject_bits,
+                msc_codes=self.msc_codes,
+                msc_offsets=self.msc_offsets,
+                msc_rows=self.msc_rows,
+            )
+        os.replace(temporary_path, path_to_index)
+
+    @classmethod
+    def load(cls, path_to_index):
+        with np.load(path_to_index) as arrays:
+            return cls(
+                int(arrays["n_papers"]),
+                arrays["subject_tags"],
+                arrays["subject_bits"],
+                arrays["msc_codes"],
+                arrays["msc_offsets"],
+                arrays["msc_rows"],
+            )
+
+    def mask(self, subjects=None, msc_prefix=None):
+        """Returns a boolean array marking the papers that carry any of subjects and an MSC code starting
+        with msc_prefix. A filter left as None does not restrict the papers.
+        """
+        mask = np.ones(self.n_papers, dtype=bool)
+
+        if subjects is not None:
+            selected = np.isin(self.subject_tags, list(subjects))
+            bits = np.bitwise_or.reduce(
+                self.subject_bits[selected],
+                axis=0,
+                initial=0,
+            )
+            mask &= np.unpackbits(bits, count=self.n_papers).astype(bool)
+
+        if msc_prefix is not None:
+            ## The codes are sorted, so the codes sharing a prefix form one contiguous run of postings.
+            first = np.searchsorted(self.msc_codes, msc_prefix, side="left")
+            last = np.searchsorted(self.msc_codes, msc_prefix + "\uffff", side="left")
+            has_code = np.zeros(self.n_papers, dtype=bool)
+            has_code[
+                self.msc_rows[self.msc_offsets[first] : self.msc_offsets[last]]
+            ] = True
+            mask &= has_code
+
+        return mask
+
+
+def postings(tag_lists):
+    """Builds an inverted index over a series of tag lists.
+
+    Returns:
+        Tuple (tags, offsets, rows): the sorted distinct tags, and the positions of the lists containing
+        tags[i] in rows[offsets[i]:offsets[i + 1]], in increasing order.
+    """
+    pairs = tag_lists.reset_index(drop=True).explode().dropna()
+    tags, codes = np.unique(pairs.to_numpy().astype(str), return_inverse=True)
+
+    order = np.lexsort((pairs.index.to_numpy(), codes))
+    rows = pairs.index.to_numpy()[order].astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(tags)))])
+
+    return tags, offsets, rows
+
+
+def build_filter_index(path_to_library):
+    """Builds the filter index of a library from its metadata and saves it as filters.npz."""
+    categories = pd.read_feather(
+        os.path.join(path_to_library, "metadata.feather"), columns=["categories"]
+    ).categories
+    index = FilterIndex.build(categories)
+    index.save(os.path.join(path_to_library, "filters.npz"))
+
+    return index
@@ -0,0 +1,648 @@
+import os
+import re
+import uuid
+import threading
+import contextlib
+import numpy as np
+import pyarrow as pa
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    ## No advisory file locks on Windows; libraries are then not protected against concurrent rebuilds.
+    fcntl = None
+
+
+class LibraryIndex:
+    """A read-only, process-resident view of a library directory.
+
+    The embeddings are held as an L2-normalized, C-contiguous float32 matrix memory-mapped from
+    embeddings.npy, so cosine similarity is a single matrix product and every process that opens
+    the same library shares its pages through the OS page cache.
+
+    The metadata is a MetadataTable memory-mapped from metadata.arrow, so opening a library reads no
+    abstracts, and a search converts only the rows and columns it returns to pandas.
+    """
+
+    def __init__(self, path_to_library) -> None:
+        self.path_to_library = path_to_library
+        ## Hold the shared lock while opening, so that library.main cannot publish a new version halfway
+        ## through and pair new embeddings with old metadata.
+        with library_lock(path_to_library):
+            if os.path.exists(os.path.join(path_to_library, "build", "publish")):
+                raise Exception(
+                    f"{path_to_library} was interrupted while publishing a new version. Run library.main again to finish it."
+                )
+            self.version = library_version(path_to_library)
+            self.embeddings = load_normalized_embeddings(path_to_library)
+            self.metadata = load_metadata_table(path_to_library)
+        self._ann = None
+        self._id_to_row = None
+        self._quantized = {}
+        self._filters = None
+        self._neighbours = None
+
+        if len(self.metadata) != self.embeddings.shape[0]:
+            raise Exception(
+                f"The metadata and embeddings of {path_to_library} are not row-aligned. Is the library being rebuilt?"
+            )
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    @property
+    def ann(self):
+        """The approximate nearest neighbour index saved as ivf.npz, or None if the library has none, or
+        only one that is older than its embeddings or covers a different number of papers.
+        """
+        if self._ann is None:
+            path_to_index = os.path.join(self.path_to_library, "ivf.npz")
+            if os.path.exists(path_to_index) and os.path.getmtime(
+                path_to_index
+            ) >= os.path.getmtime(
+                os.path.join(self.path_to_library, "embeddings.feather")
+            ):
+                from ann import IVFIndex
+
+                index = IVFIndex.load(path_to_index)
+                if len(index.list_rows) == len(self):
+                    self._ann = index
+
+        return self._ann
+
+    @property
+    def id_to_row(self):
+        """IdIndex mapping the version-less arXiv id of each paper in the library to its row number."""
+        if self._id_to_row is None:
+            self._id_to_row = IdIndex.load(
+                os.path.join(self.path_to_library, "metadata.ids.npy")
+            )
+
+        return self._id_to_row
+
+    @property
+    def filters(self):
+        """The subject and MSC filter index saved as filters.npz, built from the metadata if it is missing or
+        older than the metadata. See is_current for when the saved index is used.
+        """
+        if self._filters is None:
+            from filters import FilterIndex
+
+            path_to_index = os.path.join(self.path_to_library, "filters.npz")
+            with library_lock(self.path_to_library):
+                if self.is_current():
+                    if os.path.exists(path_to_index) and os.path.getmtime(
+                        path_to_index
+                    ) >= os.path.getmtime(
+                        os.path.join(self.path_to_library, "metadata.feather")
+                    ):
+                        self._filters = FilterIndex.load(path_to_index)
+                    else:
+                        self._filters = FilterIndex.build(
+                            self.metadata.column("categories")
+                        )
+                        self._filters.save(path_to_index)
+            if self._filters is None:
+                self._filters = FilterIndex.build(self.metadata.column("categories"))
+
+        return self._filters
+
+    @property
+    def neighbours(self):
+        """Tuple (indices, scores) of the precomputed neighbour table written by library.main, see
+        neighbours.load_neighbour_table, or None if the library has no up to date table.
+        """
+        if self._neighbours is None:
+            from neighbours import load_neighbour_table
+
+            ## Not finding a table is not remembered, so a table built later is picked up.
+            self._neighbours = load_neighbour_table(self.path_to_library)
+
+        return self._neighbours
+
+    def is_current(self):
+        """Whether the library files are still those this index was opened on. Files derived from the rows
+        are only read from or saved to the library while this holds, with the shared library_lock held so
+        that no new version is published meanwhile: an index opened before a publish builds them in memory
+        instead, since files it saved would hold the old rows and look up to date to processes opening the
+        new version.
+        """
+        return library_version(self.path_to_library) == self.version
+
+    def quantized(self, dtype):
+        """The float16 or int8 copy of the embeddings written by library.main(..., storage_dtype=dtype). A copy
+        that is older than the embeddings or has a different number of rows is rebuilt from them first. See
+        is_current for when the saved copy is used.
+        """
+        if dtype not in self._quantized:
+            from quantize import (
+                QuantizedEmbeddings,
+                write_quantized_embeddings,
+                quantize,
+            )
+
+            path_prefix = os.path.join(self.path_to_library, "embeddings")
+            path_to_codes = f"{path_prefix}.{dtype}.npy"
+            if not os.path.exists(path_to_codes):
+                raise Exception(
+                    f"This library has no {dtype} copy of its embeddings. Build it with library.main(..., storage_dtype='{dtype}')."
+                )
+
+            quantized = None
+            with library_lock(self.path_to_library):
+                if self.is_current():
+                    if os.path.getmtime(path_to_codes) >= os.path.getmtime(
+                        os.path.join(self.path_to_library, "embeddings.feather")
+                    ):
+                        quantized = QuantizedEmbeddings.load(path_prefix, dtype)
+                    if quantized is None or quantized.codes.shape[0] != len(self):
+                        write_quantized_embeddings(path_prefix, self.embeddings, dtype)
+                        quantized = QuantizedEmbeddings.load(path_prefix, dtype)
+            if quantized is None:
+                quantized = QuantizedEmbeddings(
+                    *quantize(np.asarray(self.embeddings), dtype)
+                )
+            self._quantized[dtype] = quantized
+
+        return self._quantized[dtype]
+
+    def search(
+        self,
+        query_embeddings,
+        top_k=5,
+        n_probe=None,
+        quantized=None,
+        rerank=4,
+        subjects=None,
+        msc_prefix=None,
+        block_rows=None,
+    ):
+        """Scores a batch of queries against every paper in the library.
+
+        Args:
+            query_embeddings: array of shape (n_queries, dim) or (dim,) of unnormalized query embeddings.
+            top_k: number of matches to return per query. Defaults to 5.
+            n_probe: if given, search approximately by scanning only the n_probe closest clusters of the
+            library's IVF index. Defaults to None, which searches exhaustively.
+            quantized: if 'float16' or 'int8', make a first pass over the quantized copy of the embeddings and
+            re-rank the best rerank * top_k candidates against the full-precision rows. Defaults to None.
+            rerank: size of the re-ranked shortlist as a multiple of top_k. Defaults to 4.
+            subjects: if given, only match papers carrying at least one of these arXiv subject tags.
+            msc_prefix: if given, only match papers with an MSC code starting with this prefix, e.g. '35Q'.
+            Filtered searches score the matching rows exactly, so n_probe and quantized are ignored.
+            block_rows: if given, search exhaustively by streaming embeddings.npy from disk block_rows rows at a
+            time into one reused buffer, so that memory use is set by the block size rather than the library
+            size. The results are identical to the in-memory search. Defaults to None.
+
+        Returns:
+            Tuple (indices, scores) of arrays of shape (n_queries, top_k) holding the row numbers of the
+            best matches and their cosine similarities, best match first. If fewer than top_k papers pass
+            the filters, the remaining slots hold the index -1 and the score -inf.
+        """
+        if subjects is not None or msc_prefix is not None:
+            rows = np.flatnonzero(
+                self.filters.mask(subjects=subjects, msc_prefix=msc_prefix)
+            )
+            return self._search_rows(query_embeddings, rows, top_k)
+
+        if n_probe is not None:
+            if self.ann is None:
+                raise Exception(
+                    "This library has no up to date ANN index. Build it with library.main(..., build_ann=True)."
+                )
+            return self.ann.search(
+                self.embeddings, query_embeddings, top_k=top_k, n_probe=n_probe
+            )
+
+        if quantized is not None:
+            return self.quantized(quantized).search(
+                self.embeddings, query_embeddings, top_k=top_k, rerank=rerank
+            )
+
+        queries = normalize(query_embeddings)
+        if block_rows is not None:
+            with EmbeddingBlocks(
+                os.path.join(self.path_to_library, "embeddings.npy"), block_rows
+            ) as blocks:
+                return blocked_top_k(
+                    lambda start, stop: queries @ blocks.rows(start, stop).T,
+                    len(self),
+                    top_k,
+                    block_rows=block_rows,
+                )
+
+        scores = queries @ self.embeddings.T
+
+        return top_k_rows(scores, top_k)
+
+    def _search_rows(self, query_embeddings, rows, top_k):
+        """Exhaustively scores the queries against the given rows of the library only."""
+        queries = normalize(query_embeddings)
+        indices = np.full((queries.shape[0], top_k), -1, dtype=np.int64)
+        scores = np.full((queries.shape[0], top_k), -np.inf, dtype=np.float32)
+        if len(rows) == 0:
+            return indices, scores
+
+        found_indices, found_scores = blocked_top_k(
+            lambda start, stop: queries @ self.embeddings[rows[start:stop]].T,
+            len(rows),
+            top_k,
+        )
+        indices[:, : found_indices.shape[1]] = rows[found_indices]
+        scores[:, : found_scores.shape[1]] = found_scores
+
+        return indices, scores
+
+
+def normalize(embeddings):
+    """Returns a C-contiguous float32 copy of embeddings with each row scaled to unit length."""
+    embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return np.ascontiguousarray(embeddings / norms)
+
+
+def top_k_rows(scores, top_k):
+    """Returns the column indices and values of the top_k largest entries of each row of scores,
+    sorted in decreasing order with ties broken by the smaller column index.
+    """
+    n_columns = scores.shape[1]
+    top_k = min(top_k, n_columns)
+    if top_k < n_columns:
+        ## Select everything above the k-th largest score, then fill up with the leftmost ties, so the
+        ## selection does not depend on how argpartition happens to order equal scores.
+        kth = np.partition(scores, n_columns - top_k, axis=1)[
+            :, n_columns - top_k, np.newaxis
+        ]
+        above = scores > kth
+        at = scores == kth
+        needed = top_k - above.sum(axis=1, keepdims=True)
+        selected = above | (at & (np.cumsum(at, axis=1) <= needed))
+        candidates = np.nonzero(selected)[1].reshape(scores.shape[0], top_k)
+    else:
+        candidates = np.broadcast_to(np.arange(n_columns), scores.shape)
+
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind="stable")
+
+    return (
+        np.take_along_axis(candidates, order, axis=1),
+        np.take_along_axis(candidate_scores, order, axis=1),
+    )
+
+
+def blocked_top_k(score_block, n_rows, top_k, block_rows=65536):
+    """Computes the top_k of each query over a library too large to score at once.
+
+    Args:
+        score_block: function taking (start, stop) and returning the (n_queries, stop - start) array of
+        scores of the queries against library rows start to stop.
+        n_rows: number of rows in the library.
+        top_k: number of matches to keep per query.
+        block_rows: number of library rows scored at a time. Defaults to 65536.
+
+    Returns:
+        Tuple (indices, scores) as returned by top_k_rows over the whole library, ties included.
+    """
+    best_indices = None
+    for start in range(0, n_rows, block_rows):
+        stop = min(start + block_rows, n_rows)
+        indices, scores = top_k_rows(score_block(start, stop), top_k)
+        indices = indices + start
+
+        if best_indices is None:
+            best_indices, best_scores = indices, scores
+            continue
+
+        ## Earlier blocks come first, so ties are still broken by the smaller row index.
+        merged_indices = np.concatenate([best_indices, indices], axis=1)
+        merged_scores = np.concatenate([best_scores, scores], axis=1)
+        order, best_scores = top_k_rows(merged_scores, top_k)
+        best_indices = np.take_along_axis(merged_indices, order, axis=1)
+
+    return best_indices, best_scores
+
+
+class EmbeddingBlocks:
+    """Reads row blocks of a 2-d float32 .npy file with plain file reads into one reused buffer.
+
+    Unlike slicing a memory map, the rows read do not stay resident in the process, so scanning a library
+    larger than RAM needs only block_rows rows of memory. The array returned by rows is overwritten by the
+    next call.
+    """
+
+    def __init__(self, path_to_npy, block_rows=65536) -> None:
+        self._file = open(path_to_npy, "rb")
+        version = np.lib.format.read_magic(self._file)
+        read_header = (
+            np.lib.format.read_array_header_1_0
+            if version == (1, 0)
+            else np.lib.format.read_array_header_2_0
+        )
+        shape, fortran_order, dtype = read_header(self._file)
+        if len(shape) != 2 or fortran_order or dtype != np.float32:
+            self._file.close()
+            raise Exception(f"{path_to_npy} is not a C-ordered float32 matrix.")
+
+        self.shape = shape
+        self._offset = self._file.tell()
+        self._row_bytes = shape[1] * dtype.itemsize
+        self._buffer = np.empty((min(block_rows, shape[0]), shape[1]), dtype=dtype)
+
+    def rows(self, start, stop):
+        block = self._buffer[: stop - start]
+        self._file.seek(self._offset + start * self._row_bytes)
+        self._file.readinto(memoryview(block).cast("B"))
+        return block
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MetadataTable:
+    """Reads rows of a library's metadata from metadata.arrow, an uncompressed Arrow IPC copy of
+    metadata.feather cut into small record batches and memory-mapped, so that only the batches holding the
+    requested rows are touched and only the requested rows and columns are converted to pandas.
+    """
+
+    def __init__(self, path_to_arrow) -> None:
+        self._source = pa.memory_map(path_to_arrow)
+        self._reader = pa.ipc.open_file(self._source)
+        self.columns = self._reader.schema.names
+        self._offsets = np.cumsum(
+            [0]
+            + [
+                self._reader.get_batch(number).num_rows
+                for number in range(self._reader.num_record_batches)
+            ]
+        )
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def take(self, rows, columns=None):
+        """Returns the metadata of rows, in the order given, like metadata.iloc[rows] of the full frame.
+
+        Args:
+            rows: sequence of row numbers.
+            columns: list of the columns to return. Defaults to None, which returns every column.
+
+        Returns:
+            DataFrame indexed by the row numbers.
+        """
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        columns = self.columns if columns is None else list(columns)
+        if len(rows) == 0:
+            frame = self._reader.schema.empty_table().select(columns).to_pandas()
+            frame.index = pd.Index(rows)
+            return frame
+
+        ## Gather the rows batch by batch, then put them back in the requested order.
+        batch_numbers = np.searchsorted(self._offsets, rows, side="right") - 1
+        order = np.argsort(batch_numbers, kind="stable")
+        groups = np.split(order, np.flatnonzero(np.diff(batch_numbers[order])) + 1)
+        parts = []
+        for group in groups:
+            number = batch_numbers[group[0]]
+            parts.append(
+                self._reader.get_batch(number)
+                .select(columns)
+                .take(pa.array(rows[group] - self._offsets[number]))
+            )
+        table = pa.Table.from_batches(parts).take(pa.array(np.argsort(order)))
+
+        frame = table.to_pandas()
+        frame.index = pd.Index(rows)
+        return frame
+
+    def column(self, name):
+        """Returns the whole column name as a pandas Series."""
+        return self._reader.read_all().column(name).to_pandas()
+
+    def close(self):
+        self._source.close()
+
+
+class IdIndex:
+    """Maps version-less arXiv ids to row numbers by binary search in an array of (id, row) pairs sorted by
+    id, which is memory-mapped from metadata.ids.npy rather than built into a dict when a library is opened.
+    Supports `in`, indexing and get like a dict.
+    """
+
+    def __init__(self, entries) -> None:
+        self.entries = entries
+
+    @classmethod
+    def build(cls, ids):
+        """Builds the index of a sequence of arXiv ids, one per row. If two rows share an id, the last wins."""
+        keys = np.array([base_id(paper_id).encode() for paper_id in ids], dtype=bytes)
+        entries = np.empty(
+            len(keys), dtype=[("id", keys.dtype if len(keys) else "S1"), ("row", "<i8")]
+        )
+        entries["id"] = keys
+        entries["row"] = np.arange(len(keys))
+
+        return cls(entries[np.argsort(entries["id"], kind="stable")])
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path, mmap_mode="r"))
+
+    def save(self, path):
+        temporary_path = unique_temporary_path(path)
+        with open(temporary_path, "wb") as file:
+            np.save(file, self.entries)
+        os.replace(temporary_path, path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, paper_id, default=None):
+        key = paper_id.encode()
+        ids = self.entries["id"]
+        if len(ids) == 0 or len(key) > ids.dtype.itemsize:
+            return default
+
+        position = int(np.searchsorted(ids, key, side="right")) - 1
+        if position < 0 or ids[position] != key:
+            return default
+
+        return int(self.entries["row"][position])
+
+    def __contains__(self, paper_id):
+        return self.get(paper_id) is not None
+
+    def __getitem__(self, paper_id):
+        row = self.get(paper_id)
+        if row is None:
+            raise KeyError(paper_id)
+
+        return row
+
+
+def write_metadata_table(path_to_library, batch_rows=1024):
+    """Writes metadata.arrow, the memory-mappable copy of metadata.feather read by MetadataTable, in record
+    batches of at most batch_rows rows, and metadata.ids.npy, its IdIndex. Both are copied one record batch
+    at a time and moved into place once complete.
+    """
+    path_to_arrow = os.path.join(path_to_library, "metadata.arrow")
+    path_to_ids = os.path.join(path_to_library, "metadata.ids.npy")
+
+    temporary_path = unique_temporary_path(path_to_arrow)
+
+    ids = []
+    with pa.memory_map(os.path.join(path_to_library, "metadata.feather")) as source:
+        reader = pa.ipc.open_file(source)
+        with pa.ipc.new_file(temporary_path, reader.schema) as writer:
+            for number in range(reader.num_record_batches):
+                batch = reader.get_batch(number)
+                ids.extend(batch.column("id").to_pylist())
+                for start in range(0, batch.num_rows, batch_rows):
+                    writer.write_batch(batch.slice(start, batch_rows))
+
+    IdIndex.build(ids).save(path_to_ids)
+    os.replace(temporary_path, path_to_arrow)
+
+
+def load_metadata_table(path_to_library):
+    """Opens the MetadataTable of a library, first writing metadata.arrow and metadata.ids.npy if either is
+    missing or older than metadata.feather.
+    """
+    path_to_feather = os.path.join(path_to_library, "metadata.feather")
+    paths = [
+        os.path.join(path_to_library, "metadata.arrow"),
+        os.path.join(path_to_library, "metadata.ids.npy"),
+    ]
+    if not all(os.path.exists(path) for path in paths) or min(
+        os.path.getmtime(path) for path in paths
+    ) < os.path.getmtime(path_to_feather):
+        write_metadata_table(path_to_library)
+
+    return MetadataTable(paths[0])
+
+
+@contextlib.contextmanager
+def library_lock(path_to_library, exclusive=False):
+    """Holds an advisory lock on library.lock in the library directory: shared while a LibraryIndex opens
+    the library files, exclusive while library.main moves a new version into place. Without fcntl, or if
+    the lock file cannot be created, nothing is locked.
+    """
+    file = None
+    if fcntl is not None:
+        try:
+            file = open(os.path.join(path_to_library, "library.lock"), "a")
+        except OSError:
+            pass
+    if file is None:
+        yield
+        return
+
+    with file:
+        fcntl.flock(file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def base_id(paper_id):
+    """Strips the version suffix from an arXiv id, e.g. '2301.01234v2' -> '2301.01234'."""
+    return re.sub(r"v\d+$", "", paper_id)
+
+
+def library_version(path_to_library):
+    """Returns a token that changes whenever the library's metadata or embeddings are rewritten."""
+    version = []
+    for file_name in ["metadata.feather", "embeddings.feather"]:
+        stat = os.stat(os.path.join(path_to_library, file_name))
+        version.append((stat.st_size, stat.st_mtime_ns))
+
+    return tuple(version)
+
+
+def write_normalized_embeddings(path_to_library, embeddings):
+    """Atomically writes the normalized float32 embedding matrix of a library to embeddings.npy."""
+    write_normalized_blocks(path_to_library, [embeddings], embeddings.shape)
+
+
+def write_normalized_blocks(path_to_library, blocks, shape):
+    """Writes embeddings.npy from an iterable of row blocks of an embedding matrix of the given shape,
+    normalizing one block at a time so that memory use is bounded by the block size.
+    """
+    path = os.path.join(path_to_library, "embeddings.npy")
+    temporary_path = unique_temporary_path(path)
+    normalized = np.lib.format.open_memmap(
+        temporary_path, mode="w+", dtype=np.float32, shape=tuple(shape)
+    )
+    row = 0
+    for block in blocks:
+        block = normalize(block)
+        normalized[row : row + block.shape[0]] = block
+        row += block.shape[0]
+    normalized.flush()
+    del normalized
+    os.replace(temporary_path, path)
+
+
+def unique_temporary_path(path):
+    """Returns a temporary path next to path that no other process or thread will use. Files derived on
+    first open may be built by several processes at once; each writes its own copy and moves it into place,
+    so whichever finishes last wins and every reader sees a complete file.
+    """
+    return f"{path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+
+
+def feather_blocks(path_to_feather):
+    """Yields the record batches of an embeddings feather file as float32 arrays, one batch at a time."""
+    with pa.memory_map(path_to_feather) as source:
+        reader = pa.ipc.open_file(source)
+        for batch_number in range(reader.num_record_batches):
+            batch = reader.get_batch(batch_number)
+            yield np.column_stack(
+                [column.to_numpy(zero_copy_only=False) for column in batch.columns]
+            ).astype(np.float32, copy=False)
+
+
+def load_normalized_embeddings(path_to_library):
+    """Memory-maps embeddings.npy, first building it from embeddings.feather if it is missing or stale."""
+    path_to_npy = os.path.join(path_to_library, "embeddings.npy")
+    path_to_feather = os.path.join(path_to_library, "embeddings.feather")
+
+    if not os.path.exists(path_to_npy) or os.path.getmtime(
+        path_to_npy
+    ) < os.path.getmtime(path_to_feather):
+        with pa.memory_map(path_to_feather) as source:
+            reader = pa.ipc.open_file(source)
+            n_rows = sum(
+                reader.get_batch(i).num_rows for i in range(reader.num_record_batches)
+            )
+            shape = (n_rows, len(reader.schema))
+        write_normalized_blocks(path_to_library, feather_blocks(path_to_feather), shape)
+
+    return np.load(path_to_npy, mmap_mode="r")
+
+
+_open_libraries = {}
+_lock = threading.Lock()
+
+
+def open_library(path_to_library):
+    """Returns the LibraryIndex for path_to_library, opening it only once per process and reopening it
+    if the library files have changed on disk.
+    """
+    key = os.path.abspath(path_to_library)
+    with _lock:
+        index = _open_libraries.get(key)
+        if index is None or index.version != library_version(path_to_library):
+            index = LibraryIndex(path_to_library)
+            _open_libraries[key] = index
+
+        return index
@@ -0,0 +1,115 @@
+import io
+import os
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import logging
+import resource
+
+
+def run_instrumented(
+    pipeline, X, callback=None, profile_step=None, request_id=None, profile_lines=25
+):
+    """Runs X through the transforms of an sklearn Pipeline one step at a time, measuring each step.
+
+    After every step, callback is called with a dict holding
+        request_id: identifies the request, shared by every step run for it.
+        step: name of the step in the pipeline.
+        seconds: wall time of the step.
+        rows_in, rows_out: number of rows (papers, documents or embeddings) going into and out of the step.
+        rss_bytes: resident set size of the process after the step.
+        rss_delta_bytes: change in resident set size over the step.
+        profile: only for the profiled step, the cProfile report of its profile_lines most expensive calls
+        by cumulative time.
+
+    Args:
+        pipeline: sklearn Pipeline whose steps all implement transform.
+        X: input of the first step.
+        callback: function receiving the metrics of each step, e.g. log_metrics(). Defaults to None.
+        profile_step: name of a step to run under cProfile. Defaults to None, which profiles nothing.
+        request_id: id reported with the metrics. Defaults to None, which generates one.
+        profile_lines: number of calls listed in the profile report. Defaults to 25.
+
+    Returns:
+        The output of the last step.
+    """
+    request_id = request_id or uuid.uuid4().hex[:12]
+
+    for name, step in pipeline.steps:
+        rows_in = row_count(X)
+        rss_before = current_rss()
+        profiler = cProfile.Profile() if name == profile_step else None
+
+        start = time.perf_counter()
+        if profiler is not None:
+            X = profiler.runcall(step.transform, X)
+        else:
+            X = step.transform(X)
+        seconds = time.perf_counter() - start
+
+        if callback is None:
+            continue
+
+        rss_after = current_rss()
+        metrics = {
+            "request_id": request_id,
+            "step": name,
+            "seconds": seconds,
+            "rows_in": rows_in,
+            "rows_out": row_count(X),
+            "rss_bytes": rss_after,
+            "rss_delta_bytes": rss_after - rss_before,
+        }
+        if profiler is not None:
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(
+                profile_lines
+            )
+            metrics["profile"] = report.getvalue()
+        callback(metrics)
+
+    return X
+
+
+def row_count(X):
+    if hasattr(X, "shape"):
+        return int(X.shape[0]) if len(X.shape) else 1
+    if hasattr(X, "__len__"):
+        return len(X)
+    return None
+
+
+def current_rss():
+    """Current resident set size of this process in bytes. Falls back to the peak resident set size where
+    /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        ## Linux reports KiB, macOS bytes.
+        return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+def log_metrics(logger=None, level=logging.INFO):
+    """Returns a callback for run_instrumented that logs the metrics of each step as one line of JSON.
+
+    Args:
+        logger: logging.Logger to write to. Defaults to None, which uses the 'fritz.metrics' logger.
+        level: logging level of the records. Defaults to logging.INFO.
+    """
+    logger = logger or logging.getLogger("fritz.metrics")
+
+    def callback(metrics):
+        profile = metrics.get("profile")
+        logger.log(
+            level,
+            json.dumps({k: v for k, v in metrics.items() if k != "profile"}),
+        )
+        if profile is not None:
+            logger.log(level, profile)
+
+    return callback
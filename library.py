@@ -1,25 +1,650 @@
 import os
+import json
+import queue
+import shutil
+import threading
+import numpy as np
 import pandas as pd
-from storage import query_to_df
-from cleaning import TextCleaner
-from sentence_transformers import SentenceTransformer
+import pyarrow as pa
+import pyarrow.feather as feather
+from storage import query_pages
+from cleaning import TextCleaner, cleaning_pool
+from encoders import encode, EncodingPool
+from embedding_cache import default_cache
+from index import (
+    write_normalized_blocks,
+    unique_temporary_path,
+    write_metadata_table,
+    library_lock,
+    load_normalized_embeddings,
+    feather_blocks,
+    base_id,
+)
+from ann import build_ivf_index
+from quantize import write_quantized_embeddings
+from filters import build_filter_index
+from neighbours import build_neighbour_table
+from dedup import NearDuplicateFilter
 
 
-def main(library_name, query, max_results, model_name):
+def main(
+    library_name,
+    query,
+    max_results,
+    model_name,
+    mode="create",
+    chunk_size=2000,
+    build_ann=False,
+    n_lists=None,
+    use_cache=True,
+    prefetch=2,
+    storage_dtype="float32",
+    neighbours=20,
+    dedup_threshold=0.9,
+    n_workers=None,
+    n_jobs=1,
+):
+    """Builds the library ./data/libraries/library_name from the results of an arxiv query.
+
+    Results are streamed through the build one chunk at a time. Fetching and cleaning run in background
+    threads that stay at most prefetch chunks ahead of the encoder, and every encoded chunk is written to
+    the library's build directory as Arrow record batches, so peak memory is bounded by the chunk size
+    rather than the size of the library. If a build is interrupted, calling main again with the same
+    arguments resumes it after the last completed chunk.
+
+    Args:
+        library_name: name of the library directory.
+        query: arxiv query string, see storage.query_to_df.
+        max_results: maximum number of results to pull from the API.
+        model_name: sentence transformer model used to generate embeddings.
+        mode: 'create' builds a new library and fails if one already exists. 'append' adds the results that
+        are not yet in an existing library. 'update' only fetches papers updated after the newest paper in the
+        library and replaces the older versions of papers it already holds. Defaults to 'create'.
+        chunk_size: number of results fetched, encoded and checkpointed at a time. Defaults to 2000.
+        build_ann: whether to build an IVF index for approximate search. Defaults to False.
+        n_lists: number of IVF clusters, see ann.IVFIndex.build. Defaults to None.
+        use_cache: whether to consult the default embedding cache before encoding. Defaults to True.
+        prefetch: number of chunks fetching and cleaning may run ahead of encoding. Defaults to 2.
+        storage_dtype: 'float16' or 'int8' to also store a quantized copy of the embeddings for
+        Search(quantized=...). Defaults to 'float32', which stores full precision only.
+        neighbours: number of nearest neighbours precomputed for every paper, so that get_recs can answer
+        papers already in the library by lookup. Set to 0 to skip the table. Defaults to 20.
+        dedup_threshold: estimated Jaccard similarity of the cleaned texts above which a paper is dropped as a
+        near-duplicate of one already in the library or fetched earlier in the same build, before it is
+        encoded. The MinHash signatures of the library's papers are kept in its minhash.npy. Dropped papers
+        are listed in the library's duplicates.csv with the paper they duplicate. Set to None to keep every
+        paper. Defaults to 0.9.
+        n_workers: number of worker processes encoding length-bucketed batches, see encoders.EncodingPool.
+        Defaults to None, which encodes each chunk with one call to the model in this process.
+        n_jobs: number of worker processes cleaning the chunks, see cleaning.TextCleaner. One pool is started
+        for the build. None starts one worker per core. Defaults to 1, which cleans in the background cleaning
+        thread.
+    """
     path_to_library = os.path.join("./data/libraries", library_name)
-    os.mkdir(path_to_library)
+    path_to_build = os.path.join(path_to_library, "build")
+    library_exists = os.path.exists(os.path.join(path_to_library, "metadata.feather"))
+
+    state = load_state(path_to_build)
+    build = {
+        "query": query,
+        "mode": mode,
+        "model_name": model_name,
+        "max_results": max_results,
+    }
+    if state is not None and any(state.get(key) != build[key] for key in build):
+        ## A checkpoint from a different build cannot be resumed, since its chunks would mix embeddings of
+        ## different models or result caps into one library. Start over, unless it is being published.
+        if state.get("published") or os.path.exists(
+            os.path.join(path_to_build, "publish")
+        ):
+            raise Exception(
+                f"The library {library_name} is being published by a build of {state.get('query')!r} with "
+                f"{state.get('model_name')!r}. Finish it by calling main with the same arguments."
+            )
+        shutil.rmtree(path_to_build)
+        state = None
+
+    if state is None:
+        if mode == "create" and library_exists:
+            raise Exception(
+                f"The library {library_name} already exists. Use mode='append' or mode='update' to extend it."
+            )
+        if mode in ["append", "update"] and not library_exists:
+            raise Exception(f"There is no library {library_name} to {mode}.")
+
+        state = {
+            **build,
+            "offset": 0,
+            "chunks": 0,
+            "done": False,
+            "duplicates": [],
+            "high_water_mark": (
+                high_water_mark(path_to_library) if mode == "update" else None
+            ),
+        }
+        os.makedirs(path_to_build, exist_ok=True)
+        save_state(path_to_build, state)
+    state.setdefault("duplicates", [])
+
+    known_ids = set()
+    if mode == "append":
+        known_ids = set(
+            pd.read_feather(
+                os.path.join(path_to_library, "metadata.feather"), columns=["id"]
+            ).id.map(base_id)
+        )
+    if state["high_water_mark"] is not None:
+        newest_known = pd.Timestamp(state["high_water_mark"])
+
+    cache = default_cache() if use_cache else None
+
+    ## Index the papers already in the library, and those of the chunks already checkpointed so that a
+    ## resumed build drops the same duplicates as an uninterrupted one
+    dedup = None
+    if dedup_threshold is not None:
+        dedup = NearDuplicateFilter(threshold=dedup_threshold)
+        if library_exists:
+            dedup.add(
+                feather.read_table(
+                    os.path.join(path_to_library, "metadata.feather"), columns=["id"]
+                )
+                .column("id")
+                .to_pylist(),
+                library_signatures(path_to_library),
+            )
+        for chunk_number in range(state["chunks"]):
+            path = os.path.join(path_to_build, f"chunk_{chunk_number:05d}")
+            if not os.path.exists(path + ".minhash.npy"):
+                continue
+            dedup.add(
+                feather.read_table(path + ".metadata.arrow", columns=["id"])
+                .column("id")
+                .to_pylist(),
+                np.load(path + ".minhash.npy"),
+            )
+
+    def clean_page(offset_and_page):
+        page_offset, page = offset_and_page
+        page_length = len(page)
+        reached_known_papers = False
+
+        if state["high_water_mark"] is not None:
+            ## Results come newest first, so everything after the first known paper is known too.
+            is_new = page.updated > newest_known
+            reached_known_papers = not is_new.all()
+            page = page[is_new]
+        elif known_ids:
+            page = page[~page.id.map(base_id).isin(known_ids)]
+        page = page.reset_index(drop=True)
+
+        sentences = (
+            TextCleaner(n_jobs=n_jobs, pool=cleaner_pool).transform(page)
+            if len(page) > 0
+            else []
+        )
+
+        signatures, merges = None, []
+        if dedup is not None and len(page) > 0:
+            keep, signatures, merges = dedup.filter(page.id.tolist(), sentences)
+            ## Other versions of the same paper are left for consolidate to resolve.
+            for position, merge in zip(np.flatnonzero(~keep), merges):
+                keep[position] = base_id(merge[0]) == base_id(merge[1])
+            merges = [
+                merge for merge in merges if base_id(merge[0]) != base_id(merge[1])
+            ]
+            page = page[keep].reset_index(drop=True)
+            sentences = [sentence for sentence, kept in zip(sentences, keep) if kept]
+            signatures = signatures[keep]
+
+        return (
+            page_offset,
+            page_length,
+            page,
+            sentences,
+            signatures,
+            merges,
+            reached_known_papers,
+        )
+
+    ## Fetch, clean, encode and checkpoint the results one chunk at a time, with fetching and cleaning
+    ## running ahead of encoding in background threads
+    if not state["done"]:
+        cleaner_pool = cleaning_pool(n_jobs) if n_jobs != 1 else None
+        fetched_pages = overlapped(
+            query_pages(
+                query, max_results, offset=state["offset"], page_size=chunk_size
+            ),
+            maxsize=prefetch,
+        )
+        cleaned_pages = overlapped(fetched_pages, clean_page, maxsize=prefetch)
+        pool = EncodingPool(model_name, n_workers=n_workers) if n_workers else None
+
+        try:
+            for (
+                page_offset,
+                page_length,
+                page,
+                sentences,
+                signatures,
+                merges,
+                reached_known_papers,
+            ) in cleaned_pages:
+                if len(page) > 0:
+                    embeddings = encode(
+                        model_name,
+                        sentences,
+                        cache=cache,
+                        pool=pool,
+                        show_progress_bar=True,
+                    )
+                    write_chunk(
+                        path_to_build, state["chunks"], page, embeddings, signatures
+                    )
+                    state["chunks"] += 1
+
+                state["duplicates"].extend(merges)
+                state["offset"] = page_offset + page_length
+                save_state(path_to_build, state)
+
+                if reached_known_papers:
+                    break
+        finally:
+            cleaned_pages.close()
+            if pool is not None:
+                pool.close()
+            if cleaner_pool is not None:
+                cleaner_pool.shutdown()
+
+        state["done"] = True
+        save_state(path_to_build, state)
+
+    if state["chunks"] == 0 and not library_exists:
+        shutil.rmtree(path_to_build)
+        raise Exception(f"The query {query} returned no results.")
+
+    ## Merge the checkpointed chunks into the library, keeping the newest copy of each paper
+    if state["chunks"] > 0:
+        ## The IVF index and quantized copies refer to rows by number, so the ones the library already has
+        ## are deleted by consolidate and rebuilt below. Remember them before the first attempt.
+        if "rebuild" not in state:
+            state["rebuild"] = {
+                "ann": os.path.exists(os.path.join(path_to_library, "ivf.npz")),
+                "quantized": [
+                    dtype
+                    for dtype in QUANTIZED_DTYPES
+                    if os.path.exists(
+                        os.path.join(path_to_library, f"embeddings.{dtype}.npy")
+                    )
+                ],
+            }
+            save_state(path_to_build, state)
 
-    ## Generate metadata from query and save
-    metadata = query_to_df(query=query, max_results=max_results)
-    metadata.to_feather(os.path.join(path_to_library, "metadata.feather"))
+        ## A build interrupted while publishing is finished rather than merged again.
+        if state.get("published") or os.path.exists(
+            os.path.join(path_to_build, "publish")
+        ):
+            publish(path_to_library, path_to_build)
+        elif not state.get("published"):
+            consolidate(path_to_library, path_to_build, state["chunks"], library_exists)
+        state["published"] = True
+        save_state(path_to_build, state)
+        build_filter_index(path_to_library)
 
-    ## Process and clean the data
-    sentences = TextCleaner().transform(metadata)
+        ## Store the requested quantized copy of the embeddings, and refresh the existing ones
+        for dtype in QUANTIZED_DTYPES:
+            if dtype == storage_dtype or dtype in state["rebuild"]["quantized"]:
+                write_quantized_embeddings(
+                    os.path.join(path_to_library, "embeddings"),
+                    load_normalized_embeddings(path_to_library),
+                    dtype,
+                )
 
-    ## Generate and save embeddings
-    embeddings = SentenceTransformer(model_name_or_path=model_name).encode(
-        sentences=sentences, show_progress_bar=True
+        ## Precompute the neighbours of every paper in the library
+        if neighbours and len(load_normalized_embeddings(path_to_library)) > 1:
+            build_neighbour_table(path_to_library, top_k=neighbours)
+
+        ## Optionally build an approximate nearest neighbour index for large libraries, and refresh an
+        ## existing one
+        if build_ann or state["rebuild"]["ann"]:
+            build_ivf_index(
+                path_to_library,
+                load_normalized_embeddings(path_to_library),
+                n_lists=n_lists,
+            )
+
+    if state["duplicates"]:
+        write_duplicates(path_to_library, state["duplicates"])
+
+    shutil.rmtree(path_to_build)
+
+
+def consolidate(path_to_library, path_to_build, n_chunks, keep_existing):
+    """Streams the existing library and the checkpointed chunks into new library files, dropping all but
+    the last copy of each arXiv id. Only the ids are held in memory; everything else is copied one record
+    batch at a time. The new files are written to the staging directory of the build, together with the
+    embeddings.npy and metadata sidecars and the MinHash signatures of the papers, and then moved into the
+    library by publish.
+    """
+    metadata_sources = []
+    embedding_sources = []
+    signature_sources = []
+    if keep_existing:
+        metadata_sources.append(os.path.join(path_to_library, "metadata.feather"))
+        embedding_sources.append(os.path.join(path_to_library, "embeddings.feather"))
+        signature_sources.append(library_signatures(path_to_library))
+    for chunk_number in range(n_chunks):
+        path = os.path.join(path_to_build, f"chunk_{chunk_number:05d}")
+        metadata_sources.append(path + ".metadata.arrow")
+        embedding_sources.append(path + ".embeddings.arrow")
+        signature_sources.append(
+            np.load(path + ".minhash.npy", mmap_mode="r")
+            if os.path.exists(path + ".minhash.npy")
+            else None
+        )
+
+    ids = pd.concat(
+        [
+            feather.read_table(source, columns=["id"]).column("id").to_pandas()
+            for source in metadata_sources
+        ],
+        ignore_index=True,
     )
-    embeddings_df = pd.DataFrame(embeddings)
-    embeddings_df.columns = [str(col_name) for col_name in embeddings_df.columns]
-    embeddings_df.to_feather(os.path.join(path_to_library, "embeddings.feather"))
+    is_last_copy = ~ids.map(base_id).duplicated(keep="last").to_numpy()
+
+    with pa.memory_map(embedding_sources[-1]) as source:
+        embedding_schema = pa.ipc.open_file(source).schema.remove_metadata()
+
+    path_to_staging = os.path.join(path_to_build, "staging")
+    if os.path.exists(path_to_staging):
+        shutil.rmtree(path_to_staging)
+    os.makedirs(path_to_staging)
+
+    for file_name, sources, schema in [
+        ("metadata.feather", metadata_sources, METADATA_SCHEMA),
+        ("embeddings.feather", embedding_sources, embedding_schema),
+    ]:
+        with pa.ipc.new_file(
+            os.path.join(path_to_staging, file_name), schema
+        ) as writer:
+            for batch in filtered_batches(sources, is_last_copy):
+                writer.write_batch(conform(batch, schema))
+
+    write_normalized_blocks(
+        path_to_staging,
+        feather_blocks(os.path.join(path_to_staging, "embeddings.feather")),
+        (int(is_last_copy.sum()), len(embedding_schema)),
+    )
+    write_metadata_table(path_to_staging)
+    write_signatures(
+        os.path.join(path_to_staging, "minhash.npy"),
+        metadata_sources,
+        signature_sources,
+        is_last_copy,
+    )
+
+    publish(path_to_library, path_to_build)
+
+
+def publish(path_to_library, path_to_build):
+    """Moves the files staged by consolidate into the library and deletes the IVF index and quantized
+    copies, which refer to the old row numbers.
+
+    The moves happen under the library's exclusive lock, see index.library_lock, so a process opening the
+    library sees either all of the old files or all of the new ones. The staging directory is first
+    renamed to publish; if the build is interrupted while moving, the files left in publish mark the
+    library as half published, LibraryIndex refuses to open it, and calling main again finishes the moves.
+    """
+    path_to_staging = os.path.join(path_to_build, "staging")
+    path_to_publish = os.path.join(path_to_build, "publish")
+
+    with library_lock(path_to_library, exclusive=True):
+        if os.path.exists(path_to_staging):
+            os.replace(path_to_staging, path_to_publish)
+        for file_name in PUBLISHED_FILES:
+            path = os.path.join(path_to_publish, file_name)
+            if os.path.exists(path):
+                os.replace(path, os.path.join(path_to_library, file_name))
+        for file_name in ROW_DERIVED_FILES:
+            path = os.path.join(path_to_library, file_name)
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(path_to_publish)
+
+
+def filtered_batches(sources, keep):
+    """Yields the record batches of the Arrow files in sources, restricted to the rows whose position in
+    the concatenation of all sources is marked in keep.
+    """
+    row = 0
+    for source in sources:
+        with pa.memory_map(source) as file:
+            reader = pa.ipc.open_file(file)
+            for batch_number in range(reader.num_record_batches):
+                batch = reader.get_batch(batch_number)
+                mask = keep[row : row + batch.num_rows]
+                row += batch.num_rows
+                if mask.all():
+                    yield batch
+                elif mask.any():
+                    yield batch.filter(pa.array(mask))
+
+
+def conform(batch, schema):
+    """Casts a record batch to schema, filling the columns the batch lacks with nulls."""
+    columns = [
+        (
+            batch.column(field.name).cast(field.type)
+            if field.name in batch.schema.names
+            else pa.nulls(batch.num_rows, field.type)
+        )
+        for field in schema
+    ]
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def library_signatures(path_to_library):
+    """Returns the memory-mapped MinHash signatures of the papers of a library, one row per library row, see
+    dedup.NearDuplicateFilter. Libraries built before they were stored get them computed from the metadata
+    and saved as minhash.npy.
+    """
+    path = os.path.join(path_to_library, "minhash.npy")
+    path_to_metadata = os.path.join(path_to_library, "metadata.feather")
+    with pa.memory_map(path_to_metadata) as source:
+        reader = pa.ipc.open_file(source)
+        n_rows = sum(
+            reader.get_batch(number).num_rows
+            for number in range(reader.num_record_batches)
+        )
+
+    if not (
+        os.path.exists(path)
+        and os.path.getmtime(path) >= os.path.getmtime(path_to_metadata)
+        and len(np.load(path, mmap_mode="r")) == n_rows
+    ):
+        temporary_path = unique_temporary_path(path)
+        write_signatures(
+            temporary_path, [path_to_metadata], [None], np.ones(n_rows, dtype=bool)
+        )
+        os.replace(temporary_path, path)
+
+    return np.load(path, mmap_mode="r")
+
+
+def write_signatures(path, metadata_sources, signature_sources, keep):
+    """Writes the MinHash signatures of the rows of metadata_sources marked in keep to path as an npy file.
+    They are copied from the matching entry of signature_sources, or computed from the cleaned title and
+    abstract, one record batch at a time, for sources whose entry is None.
+    """
+    minhash = NearDuplicateFilter()
+    signatures = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.uint32, shape=(int(keep.sum()), minhash.num_perm)
+    )
+    row = 0
+    written = 0
+    for metadata_source, source_signatures in zip(metadata_sources, signature_sources):
+        source_row = 0
+        with pa.memory_map(metadata_source) as file:
+            reader = pa.ipc.open_file(file)
+            for batch_number in range(reader.num_record_batches):
+                batch = reader.get_batch(batch_number)
+                mask = keep[row : row + batch.num_rows]
+                if mask.any():
+                    if source_signatures is not None:
+                        found = source_signatures[
+                            source_row : source_row + batch.num_rows
+                        ][mask]
+                    else:
+                        found = minhash.signatures(
+                            TextCleaner().transform(
+                                batch.filter(pa.array(mask)).to_pandas()
+                            )
+                        )
+                    signatures[written : written + len(found)] = found
+                    written += len(found)
+                row += batch.num_rows
+                source_row += batch.num_rows
+
+    signatures.flush()
+    del signatures
+
+
+def high_water_mark(path_to_library):
+    """Returns the update time of the newest paper in a library as an ISO string, or None if the library
+    does not record update times.
+    """
+    path_to_metadata = os.path.join(path_to_library, "metadata.feather")
+    with pa.memory_map(path_to_metadata) as source:
+        if "updated" not in pa.ipc.open_file(source).schema.names:
+            return None
+
+    updated = pd.read_feather(path_to_metadata, columns=["updated"]).updated
+    if updated.isna().all():
+        return None
+
+    return updated.max().isoformat()
+
+
+def load_state(path_to_build):
+    path_to_state = os.path.join(path_to_build, "state.json")
+    if not os.path.exists(path_to_state):
+        return None
+
+    with open(path_to_state, "r") as file:
+        return json.loads(file.read())
+
+
+def save_state(path_to_build, state):
+    path_to_state = os.path.join(path_to_build, "state.json")
+    with open(path_to_state + ".tmp", "w") as file:
+        file.write(json.dumps(state))
+    os.replace(path_to_state + ".tmp", path_to_state)
+
+
+def write_duplicates(path_to_library, duplicates):
+    """Appends (id, duplicate_of, similarity) rows to the library's report of dropped near-duplicates."""
+    path = os.path.join(path_to_library, "duplicates.csv")
+    pd.DataFrame(duplicates, columns=["id", "duplicate_of", "similarity"]).to_csv(
+        path, mode="a", header=not os.path.exists(path), index=False
+    )
+
+
+def write_chunk(path_to_build, chunk_number, metadata, embeddings, signatures=None):
+    """Writes the metadata and embeddings of one encoded chunk as uncompressed Arrow IPC files, and the
+    MinHash signatures of its papers, if given, as an npy file.
+    """
+    path = os.path.join(path_to_build, f"chunk_{chunk_number:05d}")
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+
+    feather.write_feather(
+        pa.Table.from_pandas(metadata, schema=METADATA_SCHEMA, preserve_index=False),
+        path + ".metadata.arrow",
+        compression="uncompressed",
+    )
+    feather.write_feather(
+        pa.table(
+            [embeddings[:, column] for column in range(embeddings.shape[1])],
+            names=[str(column) for column in range(embeddings.shape[1])],
+        ),
+        path + ".embeddings.arrow",
+        compression="uncompressed",
+    )
+    if signatures is not None:
+        np.save(path + ".minhash.npy", signatures)
+
+
+def overlapped(iterable, function=None, maxsize=2):
+    """Iterates over iterable, applying function to each item if one is given, in a background thread that
+    stays at most maxsize items ahead of the consumer. Exceptions raised in the background thread are
+    re-raised to the consumer, and closing the returned generator stops the thread.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if function is not None:
+                    item = function(item)
+                if not put((item, None)):
+                    return
+            put((finished, None))
+        except BaseException as error:
+            put((finished, error))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+QUANTIZED_DTYPES = ["float16", "int8"]
+
+## Files staged by consolidate, in the order publish moves them into the library.
+PUBLISHED_FILES = [
+    "metadata.feather",
+    "embeddings.feather",
+    "embeddings.npy",
+    "metadata.arrow",
+    "metadata.ids.npy",
+    "minhash.npy",
+]
+
+## Files addressing library rows by number that are not rebuilt automatically when they go stale.
+ROW_DERIVED_FILES = [
+    "ivf.npz",
+    "embeddings.float16.npy",
+    "embeddings.int8.npy",
+    "embeddings.int8.scales.npy",
+]
+
+METADATA_SCHEMA = pa.schema(
+    [
+        ("title", pa.string()),
+        ("abstract", pa.string()),
+        ("authors", pa.list_(pa.string())),
+        ("categories", pa.list_(pa.string())),
+        ("id", pa.string()),
+        ("updated", pa.timestamp("ns", tz="UTC")),
+    ]
+)
@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from index import open_library, base_id
+from storage import query_to_df, COLUMNS
+
+
+class ArxivBackend:
+    """Fetches paper metadata from the live arXiv API."""
+
+    def fetch(self, id_list):
+        return query_to_df(id_list=id_list)
+
+
+class FakeBackend:
+    """Serves paper metadata without touching the network, so the pipeline can run and be benchmarked offline.
+
+    Ids found in the optional metadata frame are served from it; any other id gets a deterministic synthetic
+    paper whose abstract contains LaTeX like real arXiv abstracts.
+    """
+
+    def __init__(self, metadata=None, latency=0.0) -> None:
+        self.metadata = metadata
+        self.latency = latency
+        self.calls = 0
+
+    def fetch(self, id_list):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        papers = fake_papers(id_list).to_dict("records")
+        if self.metadata is not None:
+            known = {
+                base_id(paper["id"]): paper
+                for paper in self.metadata.to_dict("records")
+            }
+            papers = [known.get(base_id(paper["id"]), paper) for paper in papers]
+
+        return pd.DataFrame(papers)
+
+
+class MetadataStore:
+    """A local store of arXiv metadata sitting in front of the arXiv API.
+
+    Lookups are answered, in order, from the metadata of the registered libraries, from a SQLite cache of
+    previously fetched papers younger than ttl seconds, and finally from a single batched call to the backend
+    for all remaining ids.
+    """
+
+    def __init__(
+        self,
+        path_to_store="./data/cache/metadata.sqlite",
+        ttl=7 * 24 * 3600,
+        backend=None,
+        libraries=(),
+    ) -> None:
+        self.path_to_store = path_to_store
+        self.ttl = ttl
+        self.backend = backend if backend is not None else ArxivBackend()
+        self.libraries = list(libraries)
+        self.library_hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path_to_store)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path_to_store, check_same_thread=False)
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS papers (
+                id TEXT PRIMARY KEY,
+                record TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )""")
+        self._connection.commit()
+
+    def add_library(self, path_to_library):
+        if path_to_library not in self.libraries:
+            self.libraries.append(path_to_library)
+
+    def get(self, id_list):
+        """Returns the metadata of the papers in id_list, in the same format as storage.query_to_df.
+
+        Rows follow the order of id_list. Ids unknown to every tier, including the backend, are left out.
+        """
+        requested = [base_id(paper_id) for paper_id in id_list]
+        found = {}
+
+        for path_to_library in self.libraries:
+            library = open_library(path_to_library)
+            for paper_id in requested:
+                if paper_id not in found and paper_id in library.id_to_row:
+                    found[paper_id] = (
+                        library.metadata.take([library.id_to_row[paper_id]])
+                        .iloc[0]
+                        .to_dict()
+                    )
+        self.library_hits += len(found)
+
+        cached = self._read(
+            [paper_id for paper_id in requested if paper_id not in found]
+        )
+        self.cache_hits += len(cached)
+        found.update(cached)
+
+        missing = list(dict.fromkeys(p for p in requested if p not in found))
+        self.misses += len(missing)
+        if missing:
+            fetched = self.backend.fetch(missing)
+            records = {
+                base_id(record["id"]): record for record in fetched.to_dict("records")
+            }
+            self._write(records)
+            found.update(records)
+
+        rows = [found[paper_id] for paper_id in requested if paper_id in found]
+        metadata = pd.DataFrame(rows)
+        if metadata.empty:
+            metadata = pd.DataFrame(columns=COLUMNS)
+
+        return metadata
+
+    def stats(self):
+        return {
+            "library_hits": self.library_hits,
+            "cache_hits": self.cache_hits,
+            "misses": self.misses,
+        }
+
+    def _read(self, id_list):
+        records = {}
+        oldest = time.time() - self.ttl
+        with self._lock:
+            for start in range(0, len(id_list), 500):
+                chunk = id_list[start : start + 500]
+                rows = self._connection.execute(
+                    f"SELECT id, record FROM papers WHERE fetched_at >= ? AND id IN ({','.join('?' * len(chunk))})",
+                    [oldest, *chunk],
+                ).fetchall()
+                records.update(
+                    {paper_id: json.loads(record) for paper_id, record in rows}
+                )
+
+        return records
+
+    def _write(self, records):
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO papers (id, record, fetched_at) VALUES (?, ?, ?)",
+                [
+                    (paper_id, json.dumps(record, default=_to_json), now)
+                    for paper_id, record in records.items()
+                ],
+            )
+            self._connection.commit()
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+WORDS = (
+    "operator equation solution regularity estimate boundary nonlinear wave elliptic "
+    "parabolic energy existence uniqueness space manifold spectral dispersive flow"
+).split()
+LATEX = [
+    "$L^2$",
+    "$\\Delta u = f$",
+    "$$\\int_\\Omega |\\nabla u|^2$$",
+    "$H^s(\\mathbb{R}^n)$",
+]
+SUBJECTS = ["math.AP", "math.DG", "math.SP", "math.PR", "math-ph"]
+
+
+def fake_papers(id_list):
+    """Returns deterministic synthetic metadata, one paper per id in id_list, in the format of query_to_df."""
+    rows = []
+    for paper_id in id_list:
+        rng = random.Random(paper_id)
+        words = rng.choices(WORDS, k=rng.randint(80, 200))
+        for _ in range(rng.randint(1, 6)):
+            words.insert(rng.randrange(len(words)), rng.choice(LATEX))
+        rows.append(
+            (
+                " ".join(rng.choices(WORDS, k=rng.randint(4, 12))).capitalize(),
+                " ".join(words).capitalize() + ".",
+                [f"Author {rng.randint(0, 9999)}" for _ in range(rng.randint(1, 4))],
+                rng.sample(SUBJECTS, k=rng.randint(1, 3))
+                + [
+                    f"{rng.randint(0, 99):02d}{rng.choice('ABCDEFGHJKLMNPQ')}{rng.randint(0, 99):02d}"
+                ],
+                paper_id,
+                pd.Timestamp("2020-01-01", tz="UTC")
+                + pd.Timedelta(minutes=rng.randint(0, 3 * 365 * 24 * 60)),
+            )
+        )
+
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def default_store():
+    """Returns the process-wide store at ./data/cache/metadata.sqlite. Set its backend attribute to a
+    FakeBackend to run the pipeline offline.
+    """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = MetadataStore()
+
+        return _default_store
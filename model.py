@@ -1,27 +1,207 @@
+import time
+import uuid
+import numpy as np
 import pandas as pd
 from sklearn.pipeline import Pipeline
 from storage import Fetch
 from cleaning import TextCleaner
 from embedding import Embedder
-from search import Search
+from embedding_cache import default_cache
+from metadata_store import default_store
+from search import Search, NeighbourLookup
+from index import base_id
+from instrumentation import run_instrumented
+from result_cache import default_result_cache
 
+PATH_TO_LIBRARY = "./data/libraries/APSP_50_allenai-specter"
+MODEL_NAME = "allenai-specter"
 
-def get_recs(id_list, save_recs=False):
-    path_to_library = "./data/libraries/APSP_50_allenai-specter"
+
+def get_recs(
+    id_list,
+    save_recs=False,
+    batch=False,
+    top_k=5,
+    subjects=None,
+    msc_prefix=None,
+    callback=None,
+    profile_step=None,
+    path_to_library=PATH_TO_LIBRARY,
+    model_name=MODEL_NAME,
+    store=None,
+    cache=None,
+    result_cache=None,
+):
+    """Recommends library papers similar to the arXiv papers in id_list.
+
+    Args:
+        id_list: list of arXiv ids as strings.
+        save_recs: whether to save the recommendations to ./output/. Defaults to False.
+        batch: if True, return recommendations for every id in id_list. All papers are fetched, encoded and
+        scored against the library in one pass. Defaults to False, which only recommends for the first id.
+        top_k: number of recommendations per paper. Defaults to 5.
+        subjects: if given, only recommend papers carrying one of these arXiv subject tags, e.g. ['math.AP'].
+        Defaults to None.
+        msc_prefix: if given, only recommend papers with an MSC code starting with this prefix, e.g. '35Q'.
+        Defaults to None.
+        callback: function called after each pipeline step with its wall time, row counts and memory delta,
+        see instrumentation.run_instrumented. instrumentation.log_metrics() logs them as JSON. Defaults to None.
+        profile_step: name of one step, 'fetch', 'clean', 'embed' or 'search', to run under cProfile. The
+        report is passed to callback with that step's metrics. Defaults to None.
+        path_to_library: library to recommend from. Defaults to PATH_TO_LIBRARY.
+        model_name: sentence transformer the library was encoded with. Defaults to MODEL_NAME.
+        store: MetadataStore the papers are fetched from. Defaults to None, which uses the process-wide store.
+        cache: EmbeddingCache consulted before encoding. Defaults to None, which uses the process-wide cache.
+        result_cache: ResultCache of earlier recommendations, consulted per paper before anything else is done.
+        Defaults to None, which uses the process-wide in-memory cache. Pass False to always recompute. It is
+        also bypassed when profile_step is given.
+
+    Papers that are already in the library are answered from its precomputed neighbour table, if it has one,
+    with no network or model use. Only the other papers go through the fetch, clean, embed and search pipeline.
+
+    Returns:
+        Without batch, the library metadata of the top_k recommendations. With batch, a long-format frame
+        with columns 'query_id', 'rank' and 'score' followed by the metadata of each recommendation.
+    """
     path_to_save_recs = "./output/"
 
+    ## Serve the papers recommended for before from the result cache. Its keys carry the library version,
+    ## so a rebuilt library is never answered with stale results.
+    if result_cache is None:
+        result_cache = default_result_cache()
+    use_result_cache = result_cache is not False and profile_step is None
+    keys = {}
+    cached = {}
+    if use_result_cache:
+        for paper_id in id_list if batch else id_list[:1]:
+            if base_id(paper_id) in keys:
+                continue
+            key = result_cache.key(
+                paper_id,
+                model_name,
+                path_to_library,
+                top_k,
+                subjects=subjects,
+                msc_prefix=msc_prefix,
+                batch=batch,
+            )
+            keys[base_id(paper_id)] = key
+            frame = result_cache.get(key)
+            if frame is not None:
+                cached[base_id(paper_id)] = frame
+
+    if not batch and cached:
+        recommendation_df = next(iter(cached.values()))
+        if save_recs:
+            recommendation_df.to_feather(path_to_save_recs)
+        return recommendation_df
+
+    pending = [paper_id for paper_id in id_list if base_id(paper_id) not in cached]
+    start = time.perf_counter()
+
+    store = store if store is not None else default_store()
+    store.add_library(path_to_library)
+
     ## Create pipeline
 
     model = Pipeline(
         [
-            ("fetch", Fetch()),
+            ("fetch", Fetch(store=store)),
             ("clean", TextCleaner()),
-            ("embed", Embedder(model_name="allenai-specter")),
-            ("search", Search(path_to_library=path_to_library)),
+            (
+                "embed",
+                Embedder(
+                    model_name=model_name,
+                    cache=cache if cache is not None else default_cache(),
+                ),
+            ),
+            (
+                "search",
+                Search(
+                    path_to_library=path_to_library,
+                    top_k=top_k + 1,
+                    batch=batch,
+                    subjects=subjects,
+                    msc_prefix=msc_prefix,
+                ),
+            ),
+        ]
+    )
+
+    request_id = uuid.uuid4().hex[:12]
+    instrumented = dict(
+        callback=callback, profile_step=profile_step, request_id=request_id
+    )
+
+    ## Papers already in the library are answered from its precomputed neighbour table, without fetching or
+    ## encoding them. Filtered requests always go through the search, which asks for one extra match so that
+    ## a paper found as its own nearest neighbour can be dropped, as the neighbour table does.
+    lookup = Pipeline(
+        [
+            (
+                "neighbours",
+                NeighbourLookup(
+                    path_to_library=path_to_library, top_k=top_k, batch=batch
+                ),
+            )
         ]
     )
+    known = []
+    if subjects is None and msc_prefix is None:
+        known = lookup[0].known(pending if batch else pending[:1])
+
+    if not batch and known:
+        recommendation_df = run_instrumented(lookup, known, **instrumented)
+    elif not batch:
+        recommendation_df = run_instrumented(model, id_list, **instrumented)
+        recommendation_df = recommendation_df[
+            recommendation_df.id.map(base_id) != base_id(id_list[0])
+        ].head(top_k)
+    else:
+        parts = list(cached.values())
+        if known:
+            parts.append(run_instrumented(lookup, known, **instrumented))
+
+        known_ids = set(known)
+        unknown = [paper_id for paper_id in pending if paper_id not in known_ids]
+        if unknown or not (known or cached):
+            ## Keep the fetched papers so that each query row can be traced back to its arXiv id.
+            papers = run_instrumented(model[:1], unknown, **instrumented)
+            searched = run_instrumented(model[1:], papers, **instrumented)
+            searched.insert(0, "query_id", papers.id.to_numpy()[searched.query_index])
+            searched = searched[
+                searched.id.map(base_id) != searched.query_id.map(base_id)
+            ].copy()
+            searched["rank"] = searched.groupby("query_index").cumcount() + 1
+            searched = searched[searched["rank"] <= top_k]
+            parts.append(searched.drop(columns=["query_index"]).reset_index(drop=True))
+
+        if use_result_cache and pending:
+            seconds = (time.perf_counter() - start) / len(pending)
+            for part in parts[len(cached) :]:
+                for paper_id, frame in part.groupby(part.query_id.map(base_id)):
+                    result_cache.put(
+                        keys[paper_id], frame.reset_index(drop=True), seconds
+                    )
+
+        ## Report the queries in the order of id_list, whichever way they were answered.
+        position = {}
+        for number, paper_id in enumerate(id_list):
+            position.setdefault(base_id(paper_id), number)
+        recommendation_df = pd.concat(parts, ignore_index=True)
+        recommendation_df = recommendation_df.iloc[
+            np.argsort(
+                recommendation_df.query_id.map(base_id).map(position).to_numpy(),
+                kind="stable",
+            )
+        ].reset_index(drop=True)
 
-    recommendation_df = model.transform(id_list)
+    if use_result_cache and not batch and len(recommendation_df) > 0:
+        result_cache.put(
+            keys[base_id(id_list[0])],
+            recommendation_df,
+            time.perf_counter() - start,
+        )
 
     if save_recs:
         recommendation_df.to_feather(path_to_save_recs)
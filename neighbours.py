@@ -0,0 +1,88 @@
+import os
+import numpy as np
+from index import load_normalized_embeddings, blocked_top_k
+
+
+def build_neighbour_table(
+    path_to_library, top_k=20, query_block=1024, block_rows=16384
+):
+    """Precomputes the top_k nearest neighbours of every paper in a library and saves them next to it as
+    neighbours.indices.npy and neighbours.scores.npy.
+
+    The all-pairs similarities are computed query_block papers at a time, each scored against block_rows
+    library rows at a time, so memory use is bounded by a query_block x block_rows score matrix however
+    large the library is. A paper is never its own neighbour.
+
+    Args:
+        path_to_library: path to the library directory.
+        top_k: number of neighbours kept per paper. Defaults to 20.
+        query_block: number of papers whose neighbours are computed together. Defaults to 1024.
+        block_rows: number of library rows scored at a time. Defaults to 16384.
+
+    Returns:
+        Tuple (indices, scores) of memory-mapped arrays of shape (n_papers, top_k), as returned by
+        load_neighbour_table.
+    """
+    embeddings = load_normalized_embeddings(path_to_library)
+    n_papers = embeddings.shape[0]
+    top_k = min(top_k, n_papers - 1)
+    if top_k < 1:
+        raise Exception("A neighbour table needs a library of at least two papers.")
+
+    paths = neighbour_paths(path_to_library)
+    indices = np.lib.format.open_memmap(
+        paths[0] + ".tmp", mode="w+", dtype=np.int32, shape=(n_papers, top_k)
+    )
+    scores = np.lib.format.open_memmap(
+        paths[1] + ".tmp", mode="w+", dtype=np.float32, shape=(n_papers, top_k)
+    )
+
+    for first in range(0, n_papers, query_block):
+        last = min(first + query_block, n_papers)
+        queries = np.asarray(embeddings[first:last])
+
+        def score_block(start, stop):
+            block_scores = queries @ embeddings[start:stop].T
+            ## Exclude each paper from its own neighbours.
+            overlap = np.arange(max(first, start), min(last, stop))
+            block_scores[overlap - first, overlap - start] = -np.inf
+            return block_scores
+
+        indices[first:last], scores[first:last] = blocked_top_k(
+            score_block, n_papers, top_k, block_rows=block_rows
+        )
+
+    for array in [indices, scores]:
+        array.flush()
+    del indices, scores
+    for path in paths:
+        os.replace(path + ".tmp", path)
+
+    return load_neighbour_table(path_to_library)
+
+
+def load_neighbour_table(path_to_library):
+    """Memory-maps the neighbour table of a library.
+
+    Returns:
+        Tuple (indices, scores) of arrays of shape (n_papers, top_k) holding the row numbers of each paper's
+        neighbours and their cosine similarities, best first, or None if the library has no table or the
+        table is older than the library's embeddings.
+    """
+    paths = neighbour_paths(path_to_library)
+    path_to_embeddings = os.path.join(path_to_library, "embeddings.feather")
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    if min(os.path.getmtime(path) for path in paths) < os.path.getmtime(
+        path_to_embeddings
+    ):
+        return None
+
+    return tuple(np.load(path, mmap_mode="r") for path in paths)
+
+
+def neighbour_paths(path_to_library):
+    return (
+        os.path.join(path_to_library, "neighbours.indices.npy"),
+        os.path.join(path_to_library, "neighbours.scores.npy"),
+    )
@@ -0,0 +1,132 @@
+import os
+import numpy as np
+from index import normalize, top_k_rows, blocked_top_k, unique_temporary_path
+
+
+class QuantizedEmbeddings:
+    """A compact, RAM-resident copy of a normalized embedding matrix stored as float16 or as int8 with one
+    scale per dimension.
+
+    Searches score the quantized matrix block by block to build a shortlist of rerank * top_k candidates,
+    then re-rank the shortlist exactly against the full-precision rows, which are only read from disk for
+    the candidates.
+    """
+
+    def __init__(self, codes, scales=None) -> None:
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    @classmethod
+    def load(cls, path_prefix, dtype):
+        codes = np.load(f"{path_prefix}.{dtype}.npy")
+        scales = None
+        if dtype == "int8":
+            scales = np.load(f"{path_prefix}.int8.scales.npy")
+
+        return cls(codes, scales)
+
+    def search(
+        self, full_precision, query_embeddings, top_k=5, rerank=4, block_rows=65536
+    ):
+        """Searches the quantized matrix, then re-ranks the best rerank * top_k candidates exactly.
+
+        Args:
+            full_precision: the normalized float32 embedding matrix, usually memory-mapped.
+            query_embeddings: array of shape (n_queries, dim) or (dim,) of query embeddings.
+            top_k: number of matches to return per query. Defaults to 5.
+            rerank: size of the shortlist as a multiple of top_k. Defaults to 4.
+            block_rows: number of rows dequantized at a time. Defaults to 65536.
+
+        Returns:
+            Tuple (indices, scores) as returned by LibraryIndex.search.
+        """
+        queries = normalize(query_embeddings)
+        ## Folding the int8 scales into the queries lets every block be scored as one float32 matmul.
+        scaled_queries = queries if self.scales is None else queries * self.scales
+
+        shortlist, _ = blocked_top_k(
+            lambda start, stop: scaled_queries
+            @ self.codes[start:stop].astype(np.float32).T,
+            self.codes.shape[0],
+            top_k * rerank,
+            block_rows=block_rows,
+        )
+
+        indices = np.empty(
+            (queries.shape[0], min(top_k, shortlist.shape[1])), dtype=np.int64
+        )
+        scores = np.empty(indices.shape, dtype=np.float32)
+        for query_number, candidates in enumerate(shortlist):
+            candidates = np.sort(candidates)
+            exact_scores = full_precision[candidates] @ queries[query_number]
+            best, best_scores = top_k_rows(exact_scores[np.newaxis, :], top_k)
+            indices[query_number] = candidates[best[0]]
+            scores[query_number] = best_scores[0]
+
+        return indices, scores
+
+
+def quantize(normalized, dtype, scales=None):
+    """Quantizes rows of a normalized embedding matrix.
+
+    Args:
+        normalized: float32 array of shape (n_rows, dim).
+        dtype: 'float16' or 'int8'.
+        scales: per-dimension int8 scales. Defaults to None, which computes them from normalized.
+
+    Returns:
+        Tuple (codes, scales), with scales None for float16.
+    """
+    if dtype == "float16":
+        return normalized.astype(np.float16), None
+    if dtype != "int8":
+        raise Exception(f"Unsupported storage dtype {dtype}. Use float16 or int8.")
+
+    if scales is None:
+        scales = int8_scales(normalized)
+    codes = np.clip(np.rint(normalized / scales), -127, 127).astype(np.int8)
+
+    return codes, scales
+
+
+def int8_scales(normalized, block_rows=65536):
+    """Returns the per-dimension scale mapping the largest absolute value of each dimension to 127."""
+    largest = np.zeros(normalized.shape[1], dtype=np.float32)
+    for start in range(0, normalized.shape[0], block_rows):
+        block = np.abs(normalized[start : start + block_rows])
+        largest = np.maximum(largest, block.max(axis=0))
+    largest[largest == 0] = 1
+
+    return (largest / 127).astype(np.float32)
+
+
+def write_quantized_embeddings(path_prefix, normalized, dtype, block_rows=65536):
+    """Writes a quantized copy of a normalized embedding matrix to path_prefix.<dtype>.npy, plus
+    path_prefix.int8.scales.npy for int8, converting block_rows rows at a time.
+    """
+    scales = int8_scales(normalized, block_rows) if dtype == "int8" else None
+
+    path = f"{path_prefix}.{dtype}.npy"
+    temporary_path = unique_temporary_path(path)
+    codes = np.lib.format.open_memmap(
+        temporary_path, mode="w+", dtype=np.dtype(dtype), shape=normalized.shape
+    )
+    for start in range(0, normalized.shape[0], block_rows):
+        codes[start : start + block_rows], _ = quantize(
+            np.asarray(normalized[start : start + block_rows]), dtype, scales
+        )
+    codes.flush()
+    del codes
+
+    ## The scales go first, so that whoever sees the new codes also sees their scales.
+    if scales is not None:
+        path_to_scales = f"{path_prefix}.int8.scales.npy"
+        temporary_scales_path = unique_temporary_path(path_to_scales)
+        with open(temporary_scales_path, "wb") as file:
+            np.save(file, scales)
+        os.replace(temporary_scales_path, path_to_scales)
+    os.replace(temporary_path, path)
@@ -0,0 +1,228 @@
+import os
+import time
+import sqlite3
+import threading
+import pyarrow as pa
+from collections import OrderedDict
+from index import library_version, base_id
+
+
+class ResultCache:
+    """Caches recommendation frames keyed by the query, the model, the library and its content version, the
+    number of recommendations and the filters.
+
+    Entries live in an in-memory LRU tier of at most max_entries frames and, if path_to_cache is given, in
+    a SQLite tier of at most max_disk_entries frames that survives restarts and is shared by processes.
+    Memory hits are promoted on use and disk hits are copied back into memory. The library version, see
+    index.library_version, is part of every key, so results computed before a library was rebuilt are
+    never served; the first lookup that sees a new version also deletes the library's older entries.
+
+    Each entry remembers how long it took to compute, so stats reports the latency the hits have saved.
+    """
+
+    def __init__(
+        self, max_entries=1024, path_to_cache=None, max_disk_entries=100_000
+    ) -> None:
+        self.max_entries = max_entries
+        self.path_to_cache = path_to_cache
+        self.max_disk_entries = max_disk_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._connection = None
+
+        if path_to_cache is not None:
+            directory = os.path.dirname(path_to_cache)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(path_to_cache, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    library TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    frame BLOB NOT NULL,
+                    seconds REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_library ON results (library, version)"
+            )
+            self._connection.commit()
+
+    def key(
+        self,
+        paper_id,
+        model_name,
+        path_to_library,
+        top_k,
+        subjects=None,
+        msc_prefix=None,
+        batch=False,
+    ):
+        """Returns the cache key of the recommendations for one paper, for the library's current version, as
+        a tuple (id, model_name, library path, library version, top_k, subjects, msc_prefix, batch).
+
+        Args:
+            paper_id: arXiv id of the query paper. Versions of the same paper share a key.
+            model_name: sentence transformer the library was encoded with.
+            path_to_library: library the recommendations come from.
+            top_k: number of recommendations.
+            subjects, msc_prefix: filters, see model.get_recs. Defaults to None.
+            batch: whether the frame is in the long format of get_recs(..., batch=True). Defaults to False.
+        """
+        library = os.path.abspath(path_to_library)
+        version = repr(library_version(path_to_library))
+        self._check_version(library, version)
+
+        return (
+            base_id(paper_id),
+            model_name,
+            library,
+            version,
+            top_k,
+            tuple(sorted(subjects)) if subjects is not None else None,
+            msc_prefix,
+            batch,
+        )
+
+    def get(self, key):
+        """Returns a copy of the frame cached under key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                self.seconds_saved += entry[1]
+                return entry[0].copy()
+
+            if self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT frame, seconds FROM results WHERE key = ?", (repr(key),)
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        "UPDATE results SET last_used = ? WHERE key = ?",
+                        (time.time(), repr(key)),
+                    )
+                    self._connection.commit()
+                    frame = deserialize(row[0])
+                    self._remember(key, frame, row[1])
+                    self.disk_hits += 1
+                    self.seconds_saved += row[1]
+                    return frame.copy()
+
+            self.misses += 1
+            return None
+
+    def put(self, key, frame, seconds):
+        """Caches frame under key, with the number of seconds it took to compute."""
+        with self._lock:
+            self._remember(key, frame.copy(), seconds)
+
+            if self._connection is not None:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO results (key, library, version, frame, seconds, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        repr(key),
+                        key[2],
+                        key[3],
+                        serialize(frame),
+                        seconds,
+                        time.time(),
+                    ),
+                )
+                self._evict_disk()
+                self._connection.commit()
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "hits": hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "seconds_saved": self.seconds_saved,
+            "entries": len(self._entries),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM results")
+                self._connection.commit()
+
+    def _remember(self, key, frame, seconds):
+        self._entries[key] = (frame, seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _check_version(self, library, version):
+        ## Drop the entries of a library once it has been rebuilt; they could never be hit again.
+        with self._lock:
+            if self._versions.get(library) == version:
+                return
+            self._versions[library] = version
+            for key in [
+                key for key in self._entries if key[2] == library and key[3] != version
+            ]:
+                del self._entries[key]
+            if self._connection is not None:
+                self._connection.execute(
+                    "DELETE FROM results WHERE library = ? AND version != ?",
+                    (library, version),
+                )
+                self._connection.commit()
+
+    def _evict_disk(self):
+        excess = (
+            self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            - self.max_disk_entries
+        )
+        if excess > 0:
+            self._connection.execute(
+                """DELETE FROM results WHERE rowid IN (
+                    SELECT rowid FROM results ORDER BY last_used LIMIT ?
+                )""",
+                (excess,),
+            )
+
+
+def serialize(frame):
+    """Returns a DataFrame, index included, as the bytes of an Arrow IPC stream."""
+    table = pa.Table.from_pandas(frame)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue().to_pybytes()
+
+
+def deserialize(data):
+    return pa.ipc.open_stream(pa.py_buffer(data)).read_all().to_pandas()
+
+
+_default_result_cache = None
+_default_result_cache_lock = threading.Lock()
+
+
+def default_result_cache():
+    """Returns the process-wide in-memory result cache."""
+    global _default_result_cache
+    with _default_result_cache_lock:
+        if _default_result_cache is None:
+            _default_result_cache = ResultCache()
+
+        return _default_result_cache
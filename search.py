@@ -1,30 +1,283 @@
-from sentence_transformers import util
-from sklearn.base import BaseEstimator, TransformerMixin
 import os
+import threading
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.base import BaseEstimator, TransformerMixin
+from index import open_library, top_k_rows, base_id
 
 
 class Search(BaseEstimator, TransformerMixin):
-    def __init__(self, path_to_library) -> None:
+    """Returns the library papers closest to a batch of query embeddings.
+
+    By default only the top_k matches of the first query are returned, as rows of the library metadata.
+    With batch=True every query is scored in one matrix product and the result is a long-format frame
+    with one row per (query_index, rank) pair, the match's cosine similarity in 'score', and its metadata.
+    See LibraryIndex.search for the approximate (n_probe) and quantized (quantized, rerank) search modes,
+    for restricting matches to arXiv subjects (subjects) or an MSC code prefix (msc_prefix), and for
+    streaming libraries larger than memory from disk (block_rows). Only the matched rows of the metadata
+    are read, restricted to columns if it is given.
+    """
+
+    def __init__(
+        self,
+        path_to_library,
+        n_probe=None,
+        top_k=5,
+        batch=False,
+        quantized=None,
+        rerank=4,
+        subjects=None,
+        msc_prefix=None,
+        block_rows=None,
+        columns=None,
+    ) -> None:
         super().__init__()
 
         self.path_to_library = path_to_library
+        self.n_probe = n_probe
+        self.top_k = top_k
+        self.batch = batch
+        self.quantized = quantized
+        self.rerank = rerank
+        self.subjects = subjects
+        self.msc_prefix = msc_prefix
+        self.block_rows = block_rows
+        self.columns = columns
 
     def fit(self):
         return self
 
     def transform(self, X, y=None):
-        library_metadata = pd.read_feather(
-            os.path.join(self.path_to_library, "metadata.feather")
+        library = open_library(self.path_to_library)
+
+        recommended_indices, scores = library.search(
+            X,
+            top_k=self.top_k,
+            n_probe=self.n_probe,
+            quantized=self.quantized,
+            rerank=self.rerank,
+            subjects=self.subjects,
+            msc_prefix=self.msc_prefix,
+            block_rows=self.block_rows,
         )
-        library_embeddings = pd.read_feather(
-            os.path.join(self.path_to_library, "embeddings.feather")
-        ).values
 
-        matches = util.semantic_search(
-            query_embeddings=X, corpus_embeddings=library_embeddings, top_k=5
+        if not self.batch:
+            return library.metadata.take(
+                recommended_indices[0][recommended_indices[0] >= 0], self.columns
+            )
+
+        ## Approximate and filtered searches pad queries with too few candidates with -1, drop those slots.
+        found = recommended_indices >= 0
+        query_index, rank = np.nonzero(found)
+
+        recommendations = library.metadata.take(
+            recommended_indices[found], self.columns
+        ).reset_index(drop=True)
+        recommendations.insert(0, "query_index", query_index)
+        recommendations.insert(1, "rank", rank + 1)
+        recommendations.insert(2, "score", scores[found])
+
+        return recommendations
+
+
+class ShardedSearch(BaseEstimator, TransformerMixin):
+    """Searches several libraries at once and merges their results into a global top_k.
+
+    Each shard is an independent library directory, searched in its own thread (NumPy releases the GIL
+    during the matrix products), so shards can be added or removed without rebuilding the others. The
+    output has the format of Search with two extra columns: 'shard', the name of the library a match comes
+    from, and 'score'. columns restricts the metadata columns as in Search.
+    """
+
+    def __init__(
+        self,
+        paths_to_libraries,
+        n_probe=None,
+        top_k=5,
+        batch=False,
+        quantized=None,
+        rerank=4,
+        subjects=None,
+        msc_prefix=None,
+        block_rows=None,
+        columns=None,
+    ) -> None:
+        super().__init__()
+
+        self.paths_to_libraries = paths_to_libraries
+        self.n_probe = n_probe
+        self.top_k = top_k
+        self.batch = batch
+        self.quantized = quantized
+        self.rerank = rerank
+        self.subjects = subjects
+        self.msc_prefix = msc_prefix
+        self.block_rows = block_rows
+        self.columns = columns
+
+    def fit(self):
+        return self
+
+    def add_shard(self, path_to_library):
+        if path_to_library not in self.paths_to_libraries:
+            self.paths_to_libraries = [*self.paths_to_libraries, path_to_library]
+        return self
+
+    def remove_shard(self, path_to_library):
+        self.paths_to_libraries = [
+            path for path in self.paths_to_libraries if path != path_to_library
+        ]
+        return self
+
+    def transform(self, X, y=None):
+        if not self.paths_to_libraries:
+            raise Exception("There are no shards to search.")
+
+        def search_shard(path_to_library):
+            library = open_library(path_to_library)
+            indices, scores = library.search(
+                X,
+                top_k=self.top_k,
+                n_probe=self.n_probe,
+                quantized=self.quantized,
+                rerank=self.rerank,
+                subjects=self.subjects,
+                msc_prefix=self.msc_prefix,
+                block_rows=self.block_rows,
+            )
+            return library, indices, scores
+
+        shards = list(shard_pool().map(search_shard, self.paths_to_libraries))
+
+        ## Merge the per-shard top_k lists, shard by shard, into one global top_k per query.
+        indices = np.concatenate([indices for _, indices, _ in shards], axis=1)
+        scores = np.concatenate([scores for _, _, scores in shards], axis=1)
+        scores[indices < 0] = -np.inf
+        shard_numbers = np.concatenate(
+            [
+                np.full(indices.shape, number)
+                for number, (_, indices, _) in enumerate(shards)
+            ],
+            axis=1,
         )
+        best, best_scores = top_k_rows(scores, self.top_k)
+        best_rows = np.take_along_axis(indices, best, axis=1)
+        best_shards = np.take_along_axis(shard_numbers, best, axis=1)
+
+        found = best_rows >= 0
+        query_index, rank = np.nonzero(found)
+        found_rows, found_shards = best_rows[found], best_shards[found]
+
+        parts = []
+        for number, (library, _, _) in enumerate(shards):
+            positions = np.flatnonzero(found_shards == number)
+            part = library.metadata.take(
+                found_rows[positions], self.columns
+            ).reset_index(drop=True)
+            part.insert(
+                0, "shard", os.path.basename(os.path.normpath(library.path_to_library))
+            )
+            part.index = positions
+            parts.append(part)
+        recommendations = pd.concat(parts).sort_index()
+
+        recommendations.insert(0, "query_index", query_index)
+        recommendations.insert(1, "rank", rank + 1)
+        recommendations.insert(2, "score", best_scores[found])
+
+        if not self.batch:
+            return recommendations[recommendations.query_index == 0].drop(
+                columns=["query_index", "rank"]
+            )
+
+        return recommendations.reset_index(drop=True)
+
+
+class NeighbourLookup(BaseEstimator, TransformerMixin):
+    """Answers queries for papers that are already in a library from its precomputed neighbour table, see
+    neighbours.build_neighbour_table, without fetching or encoding them.
+
+    Takes a list of arXiv ids and returns the recommendations of those that known() accepts. By default only
+    those of the first known paper are returned, as rows of the library metadata like Search. With batch=True
+    they are in the long format of Search(batch=True) with the arXiv id of each query in 'query_id' instead
+    of its index. A paper is never recommended for itself. columns restricts the metadata columns as in
+    Search.
+    """
+
+    def __init__(self, path_to_library, top_k=5, batch=False, columns=None) -> None:
+        super().__init__()
+
+        self.path_to_library = path_to_library
+        self.top_k = top_k
+        self.batch = batch
+        self.columns = columns
+
+    def fit(self):
+        return self
+
+    def known(self, id_list):
+        """Returns the ids in id_list that are in the library, or none if the library has no neighbour table
+        with at least top_k neighbours per paper.
+        """
+        library = open_library(self.path_to_library)
+        if library.neighbours is None or library.neighbours[0].shape[1] < self.top_k:
+            return []
+
+        return [
+            paper_id for paper_id in id_list if base_id(paper_id) in library.id_to_row
+        ]
+
+    def transform(self, X, y=None):
+        library = open_library(self.path_to_library)
+        rows = list(
+            dict.fromkeys(
+                library.id_to_row[base_id(paper_id)] for paper_id in self.known(X)
+            )
+        )
+        indices, scores = library.neighbours
+        if not self.batch:
+            return library.metadata.take(
+                np.asarray(indices[rows[0], : self.top_k]), self.columns
+            )
+        indices = np.asarray(indices[rows, : self.top_k])
+        scores = np.asarray(scores[rows, : self.top_k])
+
+        recommendations = library.metadata.take(
+            indices.ravel(), self.columns
+        ).reset_index(drop=True)
+        recommendations.insert(
+            0,
+            "query_id",
+            np.repeat(library.metadata.take(rows, ["id"]).id.to_numpy(), self.top_k),
+        )
+        recommendations.insert(
+            1, "rank", np.tile(np.arange(1, self.top_k + 1), len(rows))
+        )
+        recommendations.insert(2, "score", scores.ravel())
+
+        return recommendations
+
+
+_shard_pool = None
+_shard_pool_lock = threading.Lock()
+
+
+def shard_pool():
+    """Returns the process-wide thread pool shards are searched in."""
+    global _shard_pool
+    if _shard_pool is None:
+        with _shard_pool_lock:
+            if _shard_pool is None:
+                _shard_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+    return _shard_pool
 
-        recommended_indices = [dict["corpus_id"] for dict in matches[0]]
 
-        return library_metadata.iloc[recommended_indices]
+def discover_shards(path_to_libraries="./data/libraries"):
+    """Returns the paths of every library directory under path_to_libraries."""
+    return sorted(
+        os.path.join(path_to_libraries, name)
+        for name in os.listdir(path_to_libraries)
+        if os.path.exists(os.path.join(path_to_libraries, name, "metadata.feather"))
+    )
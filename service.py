@@ -0,0 +1,364 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import urllib.request
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pandas as pd
+from index import base_id, open_library
+from encoders import warm_up
+from model import get_recs, PATH_TO_LIBRARY, MODEL_NAME
+from result_cache import ResultCache, default_result_cache
+
+SERVICE_URL = os.environ.get("FRITZ_SERVICE_URL", "http://127.0.0.1:8765")
+
+
+class ServiceHTTPServer(ThreadingHTTPServer):
+    ## The default backlog of 5 pending connections resets clients under concurrent load.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class MicroBatcher:
+    """Coalesces requests arriving from many threads into batches handled by one worker thread.
+
+    The worker waits for a request, then keeps collecting requests for up to max_wait seconds or until
+    max_batch are pending, and passes them all to process_batch, which must return one result per request,
+    in order. A result that is an exception is raised to its caller alone, so one failing request does not
+    fail the rest of its batch. Each caller blocks only on the Future returned by submit.
+    """
+
+    def __init__(self, process_batch, max_batch=64, max_wait=0.005) -> None:
+        self.process_batch = process_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._closed = object()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, request):
+        future = Future()
+        self._queue.put((request, future))
+        return future
+
+    def close(self):
+        self._queue.put((self._closed, None))
+        self._thread.join()
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+        }
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_batch and items[-1][0] is not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            closing = items[-1][0] is self._closed
+            if closing:
+                items.pop()
+
+            if items:
+                self._handle(items)
+            if closing:
+                return
+
+    def _handle(self, items):
+        requests = [request for request, _ in items]
+        try:
+            results = self.process_batch(requests)
+        except Exception as error:
+            for _, future in items:
+                future.set_exception(error)
+            return
+
+        self.requests += len(items)
+        self.batches += 1
+        for (_, future), result in zip(items, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class RecommendationService:
+    """Serves get_recs over HTTP/JSON from a long-lived process that keeps the encoder and library resident.
+
+    Requests arriving within max_wait seconds of each other are answered with one batched fetch, encode and
+    search, so under concurrent load the cost per request falls as the batches grow.
+
+    Endpoints:
+        POST /recommend with a JSON body {"id_list": [...], "top_k": 5, "subjects": null, "msc_prefix": null},
+        answered with {"recommendations": [...]}, one record per row of get_recs(..., batch=True).
+        GET /health, answered with the batching statistics and, under 'result_cache', the hit rate and
+        latency saved by the result cache.
+    """
+
+    def __init__(
+        self,
+        path_to_library=PATH_TO_LIBRARY,
+        model_name=MODEL_NAME,
+        store=None,
+        cache=None,
+        result_cache=None,
+        max_batch=64,
+        max_wait=0.005,
+    ) -> None:
+        self.path_to_library = path_to_library
+        self.model_name = model_name
+        self.store = store
+        self.cache = cache
+        self.result_cache = (
+            result_cache if result_cache is not None else default_result_cache()
+        )
+        self.batcher = MicroBatcher(
+            self._process_batch, max_batch=max_batch, max_wait=max_wait
+        )
+
+    def warm_up(self):
+        warm_up(self.model_name)
+        open_library(self.path_to_library)
+
+    def recommend(self, id_list, top_k=5, subjects=None, msc_prefix=None):
+        """Returns the recommendations for every id in id_list, in the format of get_recs(..., batch=True)."""
+        return self.batcher.submit(
+            {
+                "id_list": list(id_list),
+                "top_k": top_k,
+                "subjects": tuple(subjects) if subjects is not None else None,
+                "msc_prefix": msc_prefix,
+            }
+        ).result()
+
+    def serve(self, host="127.0.0.1", port=8765):
+        """Returns an HTTP server answering requests for this service. Call serve_forever to run it."""
+        return ServiceHTTPServer((host, port), self._handler())
+
+    def _process_batch(self, requests):
+        ## Requests with the same options share one call to get_recs, and fail together only with it.
+        groups = {}
+        for position, request in enumerate(requests):
+            options = (request["top_k"], request["subjects"], request["msc_prefix"])
+            groups.setdefault(options, []).append(position)
+
+        results = [None] * len(requests)
+        for (top_k, subjects, msc_prefix), positions in groups.items():
+            id_list = list(
+                dict.fromkeys(
+                    paper_id
+                    for position in positions
+                    for paper_id in requests[position]["id_list"]
+                )
+            )
+            try:
+                recommendations = get_recs(
+                    id_list,
+                    batch=True,
+                    top_k=top_k,
+                    subjects=list(subjects) if subjects is not None else None,
+                    msc_prefix=msc_prefix,
+                    path_to_library=self.path_to_library,
+                    model_name=self.model_name,
+                    store=self.store,
+                    cache=self.cache,
+                    result_cache=self.result_cache,
+                )
+            except Exception as error:
+                for position in positions:
+                    results[position] = error
+                continue
+
+            by_query = dict(
+                list(recommendations.groupby(recommendations.query_id.map(base_id)))
+            )
+            for position in positions:
+                parts = [
+                    by_query[base_id(paper_id)]
+                    for paper_id in dict.fromkeys(requests[position]["id_list"])
+                    if base_id(paper_id) in by_query
+                ]
+                results[position] = (
+                    pd.concat(parts, ignore_index=True)
+                    if parts
+                    else recommendations.iloc[:0]
+                )
+
+        return results
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/health":
+                    return self._reply(404, {"error": f"Unknown path {self.path}"})
+                stats = {"status": "ok", **service.batcher.stats()}
+                if service.result_cache is not False:
+                    stats["result_cache"] = service.result_cache.stats()
+                self._reply(200, stats)
+
+            def do_POST(self):
+                if self.path != "/recommend":
+                    return self._reply(404, {"error": f"Unknown path {self.path}"})
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                    id_list, top_k, subjects, msc_prefix = parse_request(body)
+                except (ValueError, KeyError) as error:
+                    return self._reply(400, {"error": f"Bad request: {error}"})
+
+                try:
+                    recommendations = service.recommend(
+                        id_list, top_k=top_k, subjects=subjects, msc_prefix=msc_prefix
+                    )
+                except Exception as error:
+                    return self._reply(500, {"error": str(error)})
+
+                self._reply(
+                    200,
+                    {
+                        "recommendations": json.loads(
+                            recommendations.to_json(orient="records", date_format="iso")
+                        )
+                    },
+                )
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def parse_request(body):
+    """Returns (id_list, top_k, subjects, msc_prefix) from the JSON body of a POST /recommend, raising
+    ValueError or KeyError if it is malformed, so that a bad request is rejected before it is batched.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("the body must be a JSON object")
+    id_list = body["id_list"]
+    if not isinstance(id_list, list) or not all(
+        isinstance(paper_id, str) for paper_id in id_list
+    ):
+        raise ValueError("id_list must be a list of arXiv ids")
+    top_k = body.get("top_k", 5)
+    if isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1:
+        raise ValueError("top_k must be a positive integer")
+    subjects = body.get("subjects")
+    if subjects is not None and (
+        not isinstance(subjects, list)
+        or not all(isinstance(subject, str) for subject in subjects)
+    ):
+        raise ValueError("subjects must be null or a list of arXiv subject tags")
+    msc_prefix = body.get("msc_prefix")
+    if msc_prefix is not None and not isinstance(msc_prefix, str):
+        raise ValueError("msc_prefix must be null or a string")
+
+    return id_list, top_k, subjects, msc_prefix
+
+
+def request_recs(
+    id_list, top_k=5, subjects=None, msc_prefix=None, url=None, timeout=60
+):
+    """Asks a running RecommendationService for recommendations.
+
+    Args:
+        id_list: list of arXiv ids as strings.
+        top_k: number of recommendations per paper. Defaults to 5.
+        subjects, msc_prefix: filters, see model.get_recs. Default to None.
+        url: address of the service. Defaults to None, which uses SERVICE_URL, set by the FRITZ_SERVICE_URL
+        environment variable.
+        timeout: seconds to wait for the answer. Defaults to 60.
+
+    Returns:
+        Long-format frame of recommendations as returned by get_recs(..., batch=True).
+
+    Raises:
+        urllib.error.URLError: if the service cannot be reached or answers with an error.
+    """
+    request = urllib.request.Request(
+        (url or SERVICE_URL) + "/recommend",
+        data=json.dumps(
+            {
+                "id_list": list(id_list),
+                "top_k": top_k,
+                "subjects": subjects,
+                "msc_prefix": msc_prefix,
+            }
+        ).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        recommendations = pd.DataFrame(json.loads(response.read())["recommendations"])
+
+    if "updated" in recommendations.columns:
+        recommendations["updated"] = pd.to_datetime(recommendations.updated)
+
+    return recommendations
+
+
+def service_available(url=None, timeout=0.5):
+    """Returns whether a RecommendationService answers at url, which defaults to SERVICE_URL."""
+    try:
+        with urllib.request.urlopen((url or SERVICE_URL) + "/health", timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recommendations over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--library", default=PATH_TO_LIBRARY)
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument(
+        "--result-cache",
+        default=None,
+        help="SQLite file backing the in-memory result cache, so results survive restarts.",
+    )
+    args = parser.parse_args()
+
+    service = RecommendationService(
+        path_to_library=args.library,
+        model_name=args.model,
+        max_batch=args.max_batch,
+        max_wait=args.max_wait_ms / 1000,
+        result_cache=(
+            ResultCache(path_to_cache=args.result_cache) if args.result_cache else None
+        ),
+    )
+    service.warm_up()
+    server = service.serve(args.host, args.port)
+    print(f"Serving recommendations on http://{args.host}:{server.server_port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
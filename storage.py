@@ -1,15 +1,30 @@
-import arxiv
+import time
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import cleaning as clean
+from index import base_id
 from sklearn.base import TransformerMixin, BaseEstimator
 
 
 class Fetch(BaseEstimator, TransformerMixin):
+    """Takes a list of arXiv ids and returns their metadata, from a MetadataStore if one is given and
+    otherwise straight from the arXiv API."""
+
+    def __init__(self, store=None) -> None:
+        super().__init__()
+        self.store = store
+
     def fit(self):
         return self
 
     def transform(self, X, y=None):
+        if self.store is not None:
+            return self.store.get(X)
+
         return query_to_df(id_list=X)
 
 
@@ -70,6 +85,9 @@ class ArXivData:
         self.metadata.to_feather(path_to_dataset)
 
 
+COLUMNS = ["title", "abstract", "authors", "categories", "id", "updated"]
+
+
 def query_to_df(query=None, id_list=None, max_results=10, offset=0):
     """Returns the results of an arxiv API query in a pandas dataframe.
 
@@ -88,46 +106,285 @@ def query_to_df(query=None, id_list=None, max_results=10, offset=0):
 
         The 'links' column is dropped and the authors column is a list of each author's name as a string.
         The categories column is also a list of all tags appearing.
+        The 'updated' column holds the time of the paper's latest version.
+        Results of an id_list lookup follow the order of id_list, results of a query are newest first.
     """
-    client = arxiv.Client(page_size=2000, num_retries=10)
-
     if id_list:
-        max_results = len(id_list)
-        search = arxiv.Search(
-            id_list=id_list,
-            max_results=max_results,
-            sort_by=arxiv.SortCriterion.LastUpdatedDate,
-        )
+        return default_fetcher().fetch_ids(id_list)
+
+    if not query:
+        raise Exception("You must pass either a query string or a list of arxiv IDs")
+
+    return default_fetcher().query(query, max_results, offset=offset)
+
+
+def query_pages(query, max_results, offset=0, page_size=2000):
+    """Yields the results of an arxiv API query one page at a time.
+
+    Args:
+        query: arxiv query string, see query_to_df.
+        max_results: maximum number of results, counting the skipped ones, as in query_to_df.
+        offset: number of results to skip over initially. Defaults to 0.
+        page_size: number of results per page. Defaults to 2000.
+
+    Yields:
+        Tuples (page_offset, page) where page is a dataframe in the format of query_to_df holding the results
+        starting at position page_offset of the full result list.
+    """
+    return default_fetcher().query_pages(
+        query, max_results, offset=offset, page_size=page_size
+    )
+
+
+class RateLimiter:
+    """Spaces out events by at least min_interval seconds, across every thread that shares it.
+
+    Each call to wait reserves the next free slot under a lock and then sleeps until that slot outside of
+    it, so waiting threads are released one at a time, in the order they arrived.
+    """
+
+    def __init__(self, min_interval=3.0) -> None:
+        self.min_interval = min_interval
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval
+
+        if slot > now:
+            time.sleep(slot - now)
 
-    else:
-        if not query:
-            raise Exception(
-                "You must pass either a query string or a list of arxiv IDs"
-            )
 
-        search = arxiv.Search(
-            query=query,
-            max_results=max_results,
-            sort_by=arxiv.SortCriterion.LastUpdatedDate,
+class ArxivFetcher:
+    """Fetches arXiv metadata with several requests in flight at once.
+
+    Id lists are split into chunks of id_chunk_size ids and queries into windows of page_size results, and
+    each chunk or window is one API request run in a thread pool. Requests only go out as fast as the shared
+    rate limiter allows, which by default follows arXiv's guideline of one request every three seconds, so
+    concurrency hides the response time of the API rather than raising the request rate. Failed requests are
+    retried up to num_retries times, waiting backoff * 2**attempt seconds before each retry.
+
+    Args:
+        n_workers: number of requests in flight at once. Defaults to 4.
+        id_chunk_size: number of ids looked up per request. Defaults to 100.
+        page_size: number of query results per request, unless query_pages asks for another size. Defaults
+        to 2000.
+        num_retries: number of times a failed request is retried before the error is raised. Defaults to 5.
+        backoff: seconds to wait before the first retry, doubled before every further retry. Defaults to 1.0.
+        rate_limiter: RateLimiter shared by the requests. Defaults to None, which uses the process-wide
+        limiter, so that every fetcher in the process stays within one budget.
+        query_url_format: format string of the API endpoint, e.g. 'http://localhost:8080/api/query?{}' to
+        run against a local fake server. Defaults to None, which uses the arxiv package's endpoint.
+    """
+
+    def __init__(
+        self,
+        n_workers=4,
+        id_chunk_size=100,
+        page_size=2000,
+        num_retries=5,
+        backoff=1.0,
+        rate_limiter=None,
+        query_url_format=None,
+    ) -> None:
+        self.n_workers = n_workers
+        self.id_chunk_size = id_chunk_size
+        self.page_size = page_size
+        self.num_retries = num_retries
+        self.backoff = backoff
+        self.rate_limiter = (
+            rate_limiter if rate_limiter is not None else default_rate_limiter()
+        )
+        self.query_url_format = query_url_format
+        self.n_requests = 0
+        self.n_retries = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def fetch_ids(self, id_list):
+        """Returns the metadata of the papers in id_list, one row per distinct id, in the order of id_list.
+        An id with a version is answered with that version, one without with the latest. Ids the API does
+        not know are left out.
+        """
+        import arxiv
+
+        requested = list(dict.fromkeys(id_list))
+        chunks = [
+            requested[start : start + self.id_chunk_size]
+            for start in range(0, len(requested), self.id_chunk_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            chunk_rows = pool.map(
+                lambda chunk: self._request(
+                    arxiv.Search(id_list=chunk, max_results=len(chunk))
+                ),
+                chunks,
+            )
+            found = {}
+            for rows in chunk_rows:
+                for row in rows:
+                    found[row[4]] = row
+                    ## An id without a version stands for the latest version returned.
+                    latest = found.get(base_id(row[4]))
+                    if latest is None or row[5] > latest[5]:
+                        found[base_id(row[4])] = row
+
+        return pd.DataFrame(
+            [found[paper_id] for paper_id in requested if paper_id in found],
+            columns=COLUMNS,
         )
 
-    columns = ["title", "abstract", "authors", "categories", "id"]
+    def query(self, query, max_results, offset=0):
+        """Returns the results of a query in the format of query_to_df, newest first."""
+        pages = [page for _, page in self.query_pages(query, max_results, offset)]
+        if not pages:
+            return pd.DataFrame(columns=COLUMNS)
+
+        return pd.concat(pages, ignore_index=True)
 
-    results = client.results(search, offset=offset)
+    def query_pages(self, query, max_results, offset=0, page_size=None):
+        """Yields the results of a query one page at a time, as storage.query_pages does.
 
-    metadata_generator = (
-        (
-            result.title,
-            result.summary,
-            [author.name for author in result.authors],
-            result.categories,
-            result.entry_id.split("/")[-1],
+        Pages are requested up to n_workers ahead of the one being consumed, and always yielded in order.
+        The first page shorter than requested marks the end of the results, the requests for any later
+        pages are then dropped.
+        """
+        import arxiv
+
+        page_size = page_size or self.page_size
+        windows = (
+            (start, min(start + page_size, max_results))
+            for start in range(offset, max_results, page_size)
         )
-        for result in results
+
+        def fetch_window(window):
+            start, stop = window
+            search = arxiv.Search(
+                query=query,
+                max_results=stop,
+                sort_by=arxiv.SortCriterion.LastUpdatedDate,
+            )
+            return self._request(search, offset=start, page_size=stop - start)
+
+        with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            pending = deque(
+                (window, pool.submit(fetch_window, window))
+                for window in itertools.islice(windows, self.n_workers)
+            )
+            try:
+                while pending:
+                    (start, stop), future = pending.popleft()
+                    rows = future.result()
+                    if rows:
+                        yield start, pd.DataFrame(rows, columns=COLUMNS)
+                    if len(rows) < stop - start:
+                        return
+
+                    window = next(windows, None)
+                    if window is not None:
+                        pending.append((window, pool.submit(fetch_window, window)))
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def _request(self, search, offset=0, page_size=None):
+        """Returns the rows of the results of search from offset on. Every page the client requests waits for
+        the rate limiter, see _client, and a failed request is retried from the first row not yet received.
+        """
+        import arxiv
+        import requests
+
+        client = self._client(page_size or self.page_size)
+        rows = []
+
+        for attempt in range(self.num_retries + 1):
+            try:
+                for result in client.results(search, offset + len(rows)):
+                    rows.append(result_row(result))
+                return rows
+            except (
+                arxiv.HTTPError,
+                arxiv.UnexpectedEmptyPageError,
+                requests.RequestException,
+            ):
+                if attempt == self.num_retries:
+                    raise
+                with self._lock:
+                    self.n_retries += 1
+                time.sleep(self.backoff * 2**attempt)
+
+    def _client(self, page_size):
+        ## Each thread gets its own client, since clients hold a requests.Session and rate-limit themselves
+        ## per instance. Retries and rate limiting are handled by the fetcher instead: the client fetches
+        ## every page through _parse_feed, including the next page it requests on its own when arXiv returns
+        ## a short one, so wrapping it makes each page one rate-limited request.
+        import arxiv
+
+        clients = getattr(self._local, "clients", None)
+        if clients is None:
+            clients = self._local.clients = {}
+        if page_size not in clients:
+            client = arxiv.Client(page_size=page_size, delay_seconds=0, num_retries=0)
+            client._parse_feed = self._rate_limited(client._parse_feed)
+            clients[page_size] = client
+        if self.query_url_format is not None:
+            clients[page_size].query_url_format = self.query_url_format
+
+        return clients[page_size]
+
+    def _rate_limited(self, parse_feed):
+        def rate_limited_parse_feed(*args, **kwargs):
+            self.rate_limiter.wait()
+            with self._lock:
+                self.n_requests += 1
+
+            return parse_feed(*args, **kwargs)
+
+        return rate_limited_parse_feed
+
+
+def result_row(result):
+    """Returns the metadata of an arxiv.Result as a tuple ordered as COLUMNS."""
+    return (
+        result.title,
+        result.summary,
+        [author.name for author in result.authors],
+        result.categories,
+        ## Keep the archive of old-style ids, e.g. 'math/0601001v1'.
+        result.entry_id.split("/abs/")[-1],
+        pd.Timestamp(result.updated),
     )
 
-    returned_metadata = pd.DataFrame(metadata_generator, columns=columns)
-    return returned_metadata
+
+_default_rate_limiter = None
+_default_fetcher = None
+_default_lock = threading.Lock()
+
+
+def default_rate_limiter():
+    """Returns the process-wide rate limiter shared by every ArxivFetcher."""
+    global _default_rate_limiter
+    with _default_lock:
+        if _default_rate_limiter is None:
+            _default_rate_limiter = RateLimiter()
+
+        return _default_rate_limiter
+
+
+def default_fetcher():
+    """Returns the process-wide fetcher used by query_to_df and query_pages. Set its query_url_format
+    attribute to point the pipeline at a local fake API, e.g. benchmarks.fake_arxiv.FakeArxivServer.
+    """
+    global _default_fetcher
+    limiter = default_rate_limiter()
+    with _default_lock:
+        if _default_fetcher is None:
+            _default_fetcher = ArxivFetcher(rate_limiter=limiter)
+
+        return _default_fetcher
 
 
 # def format_query(author="", title="", cat="", abstract=""):
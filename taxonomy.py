@@ -0,0 +1,88 @@
+import json
+from functools import lru_cache
+from types import MappingProxyType
+import regex
+import pandas as pd
+
+MSC_CODE = regex.compile(r"\b\d{2}[0-9a-zA-Z]{3}\b")
+
+
+@lru_cache(maxsize=None)
+def arxiv_subjects(path_to_subjects="./data/arxiv_subjects.json"):
+    """Read-only mapping of arxiv subject tags to their english names, read from disk once per process."""
+    with open(path_to_subjects, "r") as file:
+        return MappingProxyType(json.loads(file.read()))
+
+
+@lru_cache(maxsize=None)
+def msc_tags(path_to_msc="./data/msc.json"):
+    """Read-only mapping of five digit MSC codes to their english names, read from disk once per process."""
+    with open(path_to_msc, "r") as file:
+        return MappingProxyType(json.loads(file.read()))
+
+
+@lru_cache(maxsize=None)
+def arxiv_subject_tags():
+    return frozenset(arxiv_subjects().keys())
+
+
+@lru_cache(maxsize=None)
+def msc_encoded_dict(path_to_embeddings="./data/msc_mini_embeddings.parquet"):
+    """Read-only mapping of MSC tag names to their embeddings."""
+    encoded_tags = pd.read_parquet(path_to_embeddings).to_numpy()
+    return MappingProxyType({k: v for (k, v) in zip(msc_tags().values(), encoded_tags)})
+
+
+@lru_cache(maxsize=None)
+def doc_encoded_dict(path_to_embeddings="./data/APSP_mini_vec.parquet"):
+    """Read-only mapping of document strings to their embeddings."""
+    library_embeddings = pd.read_parquet(path_to_embeddings)
+
+    docs = library_embeddings.docs.to_list()
+    encoded_docs = library_embeddings.vecs.to_numpy()
+
+    return MappingProxyType({k: v for (k, v) in zip(docs, encoded_docs)})
+
+
+def find_msc(msc_string):
+    """Returns the list of five digit MSC codes appearing in msc_string."""
+    five_digit_tags = MSC_CODE.findall(msc_string)
+    return five_digit_tags
+
+
+def filter_lists(list_column, allowed):
+    """Keeps only the items of each list in list_column that are in allowed, in their original order.
+
+    Works over the whole column at once by exploding it, so there is no Python loop over rows.
+
+    Returns:
+        Series aligned with list_column whose entries are lists, empty where no item is allowed.
+    """
+    exploded = _explode(list_column)
+    kept = exploded[exploded.isin(allowed)]
+
+    return _collect(kept, len(list_column), list_column.index, empty=list)
+
+
+def map_lists(list_column, mapping):
+    """Translates the items of each list in list_column through mapping, dropping unmapped items.
+
+    Returns:
+        Series aligned with list_column whose entries are lists of mapped items, or None where no item
+        could be mapped.
+    """
+    exploded = _explode(list_column)
+    mapped = exploded.map(mapping).dropna()
+
+    return _collect(mapped, len(list_column), list_column.index, empty=lambda: None)
+
+
+def _explode(list_column):
+    return list_column.reset_index(drop=True).explode()
+
+
+def _collect(exploded, length, index, empty):
+    grouped = exploded.groupby(level=0, sort=False).agg(list).to_dict()
+    return pd.Series(
+        [grouped.get(row, empty()) for row in range(length)], index=index, dtype=object
+    )